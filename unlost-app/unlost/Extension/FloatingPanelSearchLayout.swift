@@ -56,6 +56,7 @@ struct MemoryQueryResponse: Decodable {
     let memories: [MatchingMemoryResposne]
     let scanned_count: Int64
     let date_condition: DateCondition?
+    let cursor: String?
 }
 
 let baseUrl = "http://localhost:58000"
@@ -70,6 +71,7 @@ struct FloatingPanelSearchLayout<ItemView: View, DetailsView: View>: View {
     
     @State var queryUsed = ""
     @State var queryResultCount: Int64 = 0
+    @State var queryCursor: String? = nil
     
     @State var items = [SearchableRecord]()
     
@@ -154,6 +156,9 @@ struct FloatingPanelSearchLayout<ItemView: View, DetailsView: View>: View {
         
         if loadMore {
             queryItems.append(URLQueryItem(name: "offset", value: String(queryResultCount)))
+            if let cursor = queryCursor {
+                queryItems.append(URLQueryItem(name: "cursor", value: cursor))
+            }
         }
         
         
@@ -210,6 +215,8 @@ struct FloatingPanelSearchLayout<ItemView: View, DetailsView: View>: View {
                     } else {
                         queryResultCount = response.scanned_count
                     }
+                    // an expired cursor is replaced by the one of the repeated search
+                    queryCursor = response.cursor
                     
                     var newItems = loadMore ? items + searchableRecords : searchableRecords
                     
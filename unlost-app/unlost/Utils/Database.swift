@@ -64,6 +64,18 @@ class Database {
             }
         }
 
+        if db.userVersion == 2 {
+            // the server reads its ingestion queue from this index alone
+            do {
+                try db.execute(
+                    "CREATE INDEX IF NOT EXISTS screenshots_queue ON screenshots(has_ocr_result, created_at, id)"
+                )
+                db.userVersion = 3
+            } catch {
+                log.error("failed to run migration 3 \(error.localizedDescription)")
+            }
+        }
+
     }
     
     private func writeAheadLogging() {
@@ -0,0 +1,40 @@
+"""
+Times rectangle clustering against the pairwise implementation it replaced.
+
+    python -m benchmarks.bench_cluster_rectangles
+"""
+
+import random
+import time
+
+from src.utils.cluster_rectangles import cluster_intersecting_rectangles
+
+from .layouts import pairwise_cluster_rectangles, screen_layout
+
+SIZES = [50, 200, 400, 1000, 2000]
+LAYOUTS = 20
+THRESHOLD = 0.35
+
+
+def timed(cluster, layouts):
+    t0 = time.perf_counter()
+    for rects in layouts:
+        cluster(rects, THRESHOLD)
+    return (time.perf_counter() - t0) / len(layouts)
+
+
+def main():
+    rng = random.Random(1)
+    print(f"{'boxes':>6} {'layout':>7} {'pairwise ms':>12} {'sweep ms':>9} {'speed-up':>9}")
+    for n in SIZES:
+        for dense in (True, False):
+            layouts = [screen_layout(rng, n, dense) for _ in range(LAYOUTS)]
+            before = timed(pairwise_cluster_rectangles, layouts)
+            after = timed(cluster_intersecting_rectangles, layouts)
+            print(
+                f"{n:>6} {'dense' if dense else 'sparse':>7} {before * 1000:>12.2f} {after * 1000:>9.2f} {before / after:>8.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Compares keyword search through txtai's bm25 scoring, what hybrid indexes use, with the sqlite
+fts5 index: python heap held by the index, time to build and save it, and query latency.
+
+    python -m benchmarks.bench_keyword
+"""
+
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from src.utils.filtered_search import normalize_keyword
+
+from .keywords import keyword_database, keyword_scoring, screen_texts, vocabulary
+
+SIZES = [10_000, 50_000, 200_000]
+WORDS = 20_000
+QUERIES = 200
+LIMIT = 1000
+
+
+def measured(build):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    index = build()
+    seconds = time.perf_counter() - t0
+    heap = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return index, seconds, heap
+
+
+def timed(search, queries):
+    t0 = time.perf_counter()
+    for query in queries:
+        search(query)
+    return (time.perf_counter() - t0) / len(queries)
+
+
+def main():
+    rng = random.Random(1)
+    words = vocabulary(rng, WORDS)
+    print(
+        f"{'rows':>8} {'index':>6} {'heap MB':>8} {'build s':>8} {'save s':>7} {'query ms':>9}"
+    )
+    for n in SIZES:
+        texts = screen_texts(rng, words, n)
+        queries = [" ".join(rng.sample(words, rng.randint(1, 4))) for _ in range(QUERIES)]
+        with tempfile.TemporaryDirectory() as directory:
+            scoring, build, heap = measured(lambda: keyword_scoring(texts))
+            t0 = time.perf_counter()
+            scoring.save(os.path.join(directory, "scoring"))
+            save = time.perf_counter() - t0
+            query = timed(lambda x: scoring.search(x, LIMIT), queries)
+            print(
+                f"{n:>8} {'txtai':>6} {heap / 2**20:>8.1f} {build:>8.2f} {save:>7.2f} {query * 1000:>9.2f}"
+            )
+            scoring.close()
+            del scoring
+
+            database, build, heap = measured(lambda: keyword_database(texts))
+            t0 = time.perf_counter()
+            database.save(os.path.join(directory, "documents"))
+            save = time.perf_counter() - t0
+            query = timed(
+                lambda x: normalize_keyword(
+                    database.keyword(x, LIMIT), database.keywordaverage()
+                ),
+                queries,
+            )
+            print(
+                f"{n:>8} {'fts5':>6} {heap / 2**20:>8.1f} {build:>8.2f} {save:>7.2f} {query * 1000:>9.2f}"
+            )
+            database.close()
+
+
+if __name__ == "__main__":
+    main()
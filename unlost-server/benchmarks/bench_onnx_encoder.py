@@ -0,0 +1,61 @@
+"""
+Compares encoding throughput of the torch model with its fp32 and int8 onnx exports, and how
+close their vectors are.
+
+    python -m benchmarks.bench_onnx_encoder
+"""
+
+import os
+import random
+import time
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from src.utils.onnx_encoder import MODEL_FILES, OnnxEncoder, pooling_mode
+
+from .keywords import screen_texts, vocabulary
+
+# as in src.memory, which loads spacy so it isn't imported
+EMBEDDING_MODEL = "BAAI/bge-small-en"
+ONNX_MODEL_PATH = "./models/bge-small-en-onnx"
+TEXTS = 2000
+BATCH_SIZES = [1, 32]
+
+
+def timed(encode, texts, batch_size):
+    t0 = time.perf_counter()
+    vectors = encode(texts, batch_size=batch_size)
+    return len(texts) / (time.perf_counter() - t0), np.asarray(vectors)
+
+
+def main():
+    rng = random.Random(1)
+    texts = screen_texts(rng, vocabulary(rng, 5000), TEXTS)
+    torch_model = SentenceTransformer(EMBEDDING_MODEL)
+    pooling = pooling_mode(ONNX_MODEL_PATH, EMBEDDING_MODEL)
+
+    print(
+        f"{'model':>22} {'batch':>6} {'torch docs/s':>13} {'onnx docs/s':>12} {'speed-up':>9} {'min cosine':>11}"
+    )
+    for batch_size in BATCH_SIZES:
+        before, expected = timed(
+            lambda x, batch_size: torch_model.encode(
+                x, batch_size=batch_size, normalize_embeddings=True
+            ),
+            texts,
+            batch_size,
+        )
+        for model_file in MODEL_FILES:
+            if not os.path.exists(f"{ONNX_MODEL_PATH}/{model_file}"):
+                continue
+            onnx_model = OnnxEncoder(ONNX_MODEL_PATH, pooling, model_file)
+            after, actual = timed(onnx_model.encode, texts, batch_size)
+            cosine = (actual * expected).sum(axis=1).min()
+            print(
+                f"{model_file:>22} {batch_size:>6} {before:>13.1f} {after:>12.1f} {after / before:>8.1f}x {cosine:>11.5f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
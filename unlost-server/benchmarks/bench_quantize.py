@@ -0,0 +1,122 @@
+"""
+Compares the vector index of a shard stored as float32 with SQ8, trained on the first upsert
+the way txtai trains a new index, and trained on every row at compaction, with and without
+rescoring the candidates with the full precision vectors: recall@k against an exact search,
+query latency and memory. With SEPARATE_SNAPSHOTS a shard keeps its index twice, for the writer
+and the published snapshot, resident is the size of both. Quantized shards also keep
+vectors.f32 on disk, it's memory mapped for rescoring and only the pages of the candidates are
+read, paged is how much of it the queries touched.
+
+    python -m benchmarks.bench_quantize
+"""
+
+import tempfile
+import time
+
+import faiss
+import numpy as np
+from txtai.ann import ANNFactory
+
+from src.utils.filtered_search import rescore
+from src.utils.vectors import VectorStore, train_index
+
+SIZES = [5_000, 50_000, 200_000]
+# StoreMemory upserts this many docs at a time, src.memory loads spacy so it isn't imported
+SUB_BATCH_SIZE = 64
+VECTOR_QUANTIZE = 8
+DIMENSIONS = 384
+CLUSTERS = 200
+QUERIES = 200
+K = 10
+# similar clauses fetch 10x the limit, like filtered_search
+FETCH = K * 10
+PAGE = 4096
+# the writer and the published snapshot
+COPIES = 2
+
+
+def embeddings(rng: np.random.Generator, n: int):
+    """
+    Normalized vectors around topic centers, with dimensions of very different spread like
+    sentence embeddings have.
+    """
+    scale = rng.gamma(1.0, 1.0, DIMENSIONS).astype(np.float32)
+    centers = rng.standard_normal((CLUSTERS, DIMENSIONS)).astype(np.float32) * scale
+    vectors = centers[rng.integers(0, CLUSTERS, n)] + (
+        rng.standard_normal((n, DIMENSIONS)).astype(np.float32) * scale * 0.7
+    )
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def create(quantize):
+    return ANNFactory.create(
+        {"backend": "faiss", "faiss": {"quantize": quantize} if quantize else {}}
+    )
+
+
+def first_upsert(vectors: np.ndarray, quantize):
+    # a new index is built by the first sub batch, the rest is appended to it
+    ann = create(quantize)
+    ann.index(vectors[:SUB_BATCH_SIZE])
+    for i in range(SUB_BATCH_SIZE, len(vectors), SUB_BATCH_SIZE):
+        ann.append(vectors[i : i + SUB_BATCH_SIZE])
+    return ann
+
+
+def compacted(vectors: np.ndarray, store: VectorStore):
+    ann = first_upsert(vectors, None)
+    ann.config["faiss"] = {"quantize": VECTOR_QUANTIZE}
+    train_index(ann, store, np.arange(len(vectors)), DIMENSIONS)
+    return ann
+
+
+def measure(ann, queries: np.ndarray, exact: np.ndarray, store: VectorStore | None):
+    recall, pages, t0 = 0, set(), time.perf_counter()
+    for x, query in enumerate(queries):
+        results = ann.search(query[None], FETCH)[0]
+        if store is not None:
+            results = rescore(store, query, results)
+            pages.update(i * DIMENSIONS * 4 // PAGE for i, _ in results)
+        found = {i for i, _ in results[:K]}
+        recall += len(found & set(exact[x].tolist())) / K
+    latency = (time.perf_counter() - t0) / len(queries)
+    resident = len(faiss.serialize_index(ann.backend)) * COPIES
+    return recall / len(queries), latency, resident, len(pages) * PAGE
+
+
+def main():
+    rng = np.random.default_rng(1)
+    print(
+        f"{'rows':>8} {'index':>24} {'recall@10':>10} {'query ms':>9} {'resident MB':>12} {'store MB':>9} {'paged MB':>9}"
+    )
+    for n in SIZES:
+        vectors = embeddings(rng, n)
+        queries = vectors[rng.integers(0, n, QUERIES)] + rng.standard_normal(
+            (QUERIES, DIMENSIONS)
+        ).astype(np.float32) * 0.02
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        exact = np.argsort(-(queries @ vectors.T), axis=1)[:, :K]
+
+        with tempfile.NamedTemporaryFile(suffix=".f32") as handle:
+            store = VectorStore(handle.name)
+            store.write(0, vectors, reset=True)
+            cases = [
+                ("float32", lambda: first_upsert(vectors, None), None),
+                ("sq8 first upsert", lambda: first_upsert(vectors, VECTOR_QUANTIZE), None),
+                ("sq8 first upsert+rescore", lambda: first_upsert(vectors, VECTOR_QUANTIZE), store),
+                ("sq8 compacted", lambda: compacted(vectors, store), None),
+                ("sq8 compacted+rescore", lambda: compacted(vectors, store), store),
+            ]
+            for name, build, rescored in cases:
+                ann = build()
+                recall, latency, resident, paged = measure(ann, queries, exact, rescored)
+                # float32 shards don't need the store
+                stored = vectors.nbytes if name != "float32" else 0
+                print(
+                    f"{n:>8} {name:>24} {recall:>10.3f} {latency * 1000:>9.2f} {resident / 2**20:>12.1f} {stored / 2**20:>9.1f} {paged / 2**20:>9.1f}"
+                )
+                del ann
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Times the search of a shard at the limit a new search now fetches with, FIRST_SEARCH_LIMIT, and
+at SEARCH_LIMIT, which every first page fetched before. Searches go through filtered_search like
+text queries on fts5 indexes do. The first word of a text picks one of TOPICS random topic
+vectors and the rest of its words move it around the topic, a query scores above the server's
+0.25 threshold against the texts of its topic.
+
+    python -m benchmarks.bench_search_page
+"""
+
+import random
+import time
+from hashlib import sha1
+
+import numpy as np
+from txtai.embeddings import Embeddings
+
+from src.utils.filtered_search import filtered_search
+
+from .keywords import META, screen_texts, vocabulary
+
+# as in src.memory, which loads spacy so it isn't imported
+PAGE_SIZE = 20 * 8
+FIRST_SEARCH_LIMIT = PAGE_SIZE * 2
+SEARCH_LIMIT = PAGE_SIZE * 5
+SIZES = [10_000, 50_000]
+DIMENSIONS = 384
+WORDS = 5000
+TOPICS = 40
+QUERIES = 50
+SEARCH = """
+    select text, score, json_group_array(meta) as rows, json_group_array(id) as ids
+    from txtai
+    where similar('{q}') and score > 0.25
+    group by text
+    order by score desc
+    limit {limit}
+"""
+
+
+def word_vector(word: str):
+    seed = int(sha1(word.encode("utf-8")).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).standard_normal(DIMENSIONS).astype(np.float32)
+
+
+topics = np.random.default_rng(1).standard_normal((TOPICS, DIMENSIONS)).astype(np.float32)
+
+
+def encode(texts):
+    vectors = []
+    for text in texts:
+        words = text.split()
+        topic = topics[int(sha1(words[0].encode("utf-8")).hexdigest()[:8], 16) % TOPICS]
+        noise = sum(word_vector(x) for x in words)
+        vectors.append(topic + noise / np.linalg.norm(noise) * np.linalg.norm(topic) * 0.7)
+    vectors = np.array(vectors)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def main():
+    rng = random.Random(1)
+    words = vocabulary(rng, WORDS)
+    print(f"{'rows':>8} {'limit':>6} {'query ms':>9} {'results':>8}")
+    for n in SIZES:
+        texts = screen_texts(rng, words, n)
+        instance = Embeddings(
+            {
+                "method": "external",
+                "transform": encode,
+                "content": "src.custom_sqlite.sqlite.SQLite",
+                "keyword_backend": "fts5",
+            }
+        )
+        instance.index(
+            [(str(i), {"text": text, "meta": META}, None) for i, text in enumerate(texts)]
+        )
+        queries = [" ".join(rng.sample(words[:500], 2)) for _ in range(QUERIES)]
+        for limit in (FIRST_SEARCH_LIMIT, SEARCH_LIMIT):
+            found, t0 = 0, time.perf_counter()
+            for text in queries:
+                query = SEARCH.format(q=text, limit=limit)
+                found += len(filtered_search(instance, query, text, None, limit, 0.5))
+            latency = (time.perf_counter() - t0) / len(queries)
+            print(f"{n:>8} {limit:>6} {latency * 1000:>9.1f} {found / len(queries):>8.0f}")
+        instance.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Compares the sentence boundaries the senter component finds in paragraph blocks with the
+parser's, which the full pipeline used, and how fast each segments them. Blocks are laid out from
+the ocr results of a document directory's db.sqlite3 when one is given, from SAMPLE_BLOCKS
+otherwise.
+
+    python -m benchmarks.bench_segmentation [document path]
+"""
+
+import json
+import sqlite3
+import sys
+import time
+
+import en_core_web_sm
+
+from src.utils.boxes import ScreenshotBoxes
+from src.utils.state import load_segmenter
+from src.utils.transform_memory import SEGMENT_BATCH_SIZE, layout_memory
+
+SCREENSHOTS = 500
+
+# paragraph blocks as they come out of layout_memory, ocr lines joined with spaces
+SAMPLE_BLOCKS = [
+    "Hi team, the release is moved to Thursday. Please merge your PRs by Wednesday 5pm "
+    "so QA has a full day Thanks Anna",
+    "Inbox (128) Primary Social Promotions Your order has shipped Track package "
+    "Arriving tomorrow by 9pm",
+    "def transform_memory(boxes): # filter out results that are too high "
+    "first = boxes[0] return layout",
+    "Q3 planning doc Owner: Mark Status: draft Goals 1. Reduce p95 search latency "
+    "2. Ship onnx encoder 3. Cut memory use by 30%",
+    "Error: connection refused at 127.0.0.1:58000 Retrying in 5 seconds... "
+    "Retry 2/5 failed. Giving up",
+    "The quick summary: revenue grew 12% q/q. Churn was flat. "
+    "We expect margins to improve in H2 as infra costs drop",
+    "Settings General Appearance Privacy & Security Notifications Do not disturb "
+    "Focus mode is on until 6:00 PM",
+    "lol yeah that works for me see you at 7 dont forget the tickets ok "
+    "on my way now traffic is bad",
+    "Terms of Service Last updated: March 3, 2024 By using the app you agree to these terms. "
+    "If you do not agree, do not use the app.",
+    "PR #482 fix: handle empty ocr results reviewed by @lena approved 2 comments "
+    "CI passed in 4m 12s Merge pull request",
+    "Dr. Smith's notes: pt. reports mild pain since Jan. 4th, no fever. "
+    "Follow up in 2 wks. Rx: ibuprofen 400 mg",
+    "Meeting notes - standup Alice: finished the cursor work, starting on pagination "
+    "Bob: blocked on the migration Carol: out today",
+]
+
+
+def screenshot_blocks(document_path: str) -> list[str]:
+    connection = sqlite3.connect(f"{document_path}/db.sqlite3")
+    rows = connection.execute(
+        """
+        SELECT id, width, height, ocr_result FROM screenshots
+        WHERE has_ocr_result = 1 AND is_transcription = 0
+        ORDER BY created_at DESC LIMIT ?
+        """,
+        [SCREENSHOTS],
+    ).fetchall()
+    blocks = []
+    for id, width, height, ocr_result in rows:
+        boxes = ScreenshotBoxes(
+            screenshot_id=str(id),
+            app_name="",
+            window_name="",
+            captured_at="",
+            screenshot_path="",
+            screenshot_time=0.0,
+            screenshot_minX=None,
+            screenshot_minY=None,
+            screenshot_width=width,
+            screenshot_height=height,
+            url=None,
+        )
+        for i, x in enumerate(json.loads(ocr_result)):
+            if len(x["value"]) > 1:
+                boxes.append(f"{id}#{i}", x["value"], x["location"])
+        if len(boxes) == 0:
+            continue
+        blocks += [
+            paragraph.text
+            for _, paragraph in layout_memory(boxes).clusters
+            if paragraph is not None
+        ]
+    return blocks
+
+
+def segmented(nlp, blocks: list[str]):
+    t0 = time.perf_counter()
+    docs = list(nlp.pipe(blocks, batch_size=SEGMENT_BATCH_SIZE))
+    seconds = time.perf_counter() - t0
+    # character offsets of the sentence starts, the first one is always 0
+    starts = [{sentence.start_char for sentence in doc.sents} for doc in docs]
+    return starts, len(blocks) / seconds
+
+
+def main():
+    blocks = screenshot_blocks(sys.argv[1]) if len(sys.argv) > 1 else SAMPLE_BLOCKS
+    pipelines = [
+        ("full pipeline", en_core_web_sm.load()),
+        ("parser", load_segmenter(False)),
+        ("senter", load_segmenter(True)),
+    ]
+    results = {name: segmented(nlp, blocks) for name, nlp in pipelines}
+    parser_starts = results["parser"][0]
+
+    print(f"{len(blocks)} blocks")
+    print(
+        f"{'segmenter':>14} {'blocks/s':>9} {'sentences':>10} {'same blocks':>12} {'precision':>10} {'recall':>7}"
+    )
+    for name, (starts, speed) in results.items():
+        same = sum(a == b for a, b in zip(starts, parser_starts)) / len(blocks)
+        # boundaries after the first sentence, against the parser's
+        found = sum(len(a - {0}) for a in starts)
+        expected = sum(len(b - {0}) for b in parser_starts)
+        matched = sum(len((a & b) - {0}) for a, b in zip(starts, parser_starts))
+        precision = matched / found if found else 1.0
+        recall = matched / expected if expected else 1.0
+        sentences = sum(len(x) for x in starts)
+        print(
+            f"{name:>14} {speed:>9.1f} {sentences:>10} {same:>12.3f} {precision:>10.3f} {recall:>7.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import json
+import random
+
+from txtai.scoring import ScoringFactory
+
+from src.custom_sqlite.sqlite import SQLite
+
+# the scoring txtai builds for "keyword" or "hybrid" indexes
+TXTAI_SCORING = {"method": "bm25", "terms": True, "normalize": True}
+META = json.dumps(
+    {
+        "app_name": "bench",
+        "window_name": "bench",
+        "captured_at": "2023-01-01T00:00:00",
+        "path": "bench.png",
+        # transcriptions aren't deduplicated, random texts can repeat
+        "is_transcription": True,
+    }
+)
+
+
+def vocabulary(rng: random.Random, n: int):
+    return [
+        "".join(rng.choice("bcdfghklmnprstvz") + rng.choice("aeiou") for _ in range(3))
+        for _ in range(n)
+    ]
+
+
+def screen_texts(rng: random.Random, words: list[str], n: int):
+    """
+    Random ocr sections, word frequencies follow a zipf distribution like screen text does.
+    """
+    weights = [1 / (i + 1) for i in range(len(words))]
+    return [" ".join(rng.choices(words, weights, k=rng.randint(3, 40))) for _ in range(n)]
+
+
+def keyword_scoring(texts: list[str]):
+    scoring = ScoringFactory.create(dict(TXTAI_SCORING))
+    scoring.index([(i, text, None) for i, text in enumerate(texts)])
+    return scoring
+
+
+def keyword_database(texts: list[str]):
+    database = SQLite({"keyword_backend": "fts5"})
+    database.insert([(str(i), {"text": text, "meta": META}, None) for i, text in enumerate(texts)])
+    return database
@@ -0,0 +1,75 @@
+import random
+
+
+def screen_layout(rng: random.Random, n: int, dense: bool):
+    """
+    Random ocr boxes in relative coordinates. Dense layouts are rows and columns of text lines,
+    like an editor or a chat, sparse layouts are scattered boxes of any size.
+    """
+    rects = []
+    for _ in range(n):
+        if dense:
+            row, col = rng.randrange(60), rng.randrange(8)
+            x = col * 0.12 + rng.random() * 0.02
+            y = row * 0.016
+            w = 0.05 + rng.random() * 0.07
+            h = 0.012 + rng.random() * 0.002
+        else:
+            x, y = rng.random(), rng.random()
+            w, h = rng.random() * 0.2, rng.random() * 0.05
+        rects.append([x, y, x + w, y + h])
+    return rects
+
+
+# the pairwise implementation cluster_rectangles replaced, kept to check and time against
+
+
+def is_overlapping(rect1, rect2):
+    xmin1, ymin1, xmax1, ymax1 = rect1
+    xmin2, ymin2, xmax2, ymax2 = rect2
+    return (xmin1 < xmax2 and xmin2 < xmax1) and (ymin1 < ymax2 and ymin2 < ymax1)
+
+
+def is_similar(rect1, rect2, threshold):
+    dy1 = rect1[3] - rect1[1]
+    dy2 = rect2[3] - rect2[1]
+    return abs(dy1 - dy2) / max(dy1, dy2) < threshold
+
+
+def expand_rectangle(rect, threshold):
+    dx = (rect[2] - rect[0]) * threshold
+    dy = (rect[3] - rect[1]) * threshold
+    d = min(dx, dy)
+    return [rect[0] - d, rect[1] - d, rect[2] + d, rect[3] + d]
+
+
+def pairwise_cluster_rectangles(rects, threshold):
+    rectangles = [expand_rectangle(rect, threshold) for rect in rects]
+    graph = {i: set() for i in range(len(rectangles))}
+    for i in range(len(rectangles)):
+        for j in range(i + 1, len(rectangles)):
+            if is_overlapping(rectangles[i], rectangles[j]) and is_similar(
+                rectangles[i], rectangles[j], threshold * 0.75
+            ):
+                graph[i].add(j)
+                graph[j].add(i)
+
+    clusters = []
+    visited = set()
+    for node in range(len(rectangles)):
+        if node in visited:
+            continue
+        visited.add(node)
+        cluster = [node]
+        stack = [iter(graph[node])]
+        while stack:
+            for neighbor in stack[-1]:
+                if neighbor not in visited:
+                    visited.add(neighbor)
+                    cluster.append(neighbor)
+                    stack.append(iter(graph[neighbor]))
+                    break
+            else:
+                stack.pop()
+        clusters.append([rects[x] for x in cluster])
+    return clusters
@@ -4,6 +4,8 @@ FileDB module
 
 import datetime
 import json
+import math
+import re
 from txtai.database import Database
 
 
@@ -95,9 +97,49 @@ class FileDB(Database):
     DROP_SECTIONS = "DROP TABLE sections"
     RENAME_SECTIONS = "ALTER TABLE %s RENAME TO sections"
 
+    # Occurrences - repeated sightings of an indexed section
+    CREATE_OCCURRENCES = """
+        CREATE TABLE IF NOT EXISTS occurrences (
+            id TEXT,
+            captured_at TEXT,
+            path TEXT,
+            time REAL,
+            location TEXT,
+            entry DATETIME
+        )
+    """
+
+    CREATE_OCCURRENCES_INDEX = (
+        "CREATE INDEX IF NOT EXISTS occurrence_id ON occurrences(id)"
+    )
+    INSERT_OCCURRENCE = "INSERT INTO occurrences VALUES (?, ?, ?, ?, ?, ?)"
+    DELETE_OCCURRENCES = "DELETE FROM occurrences WHERE id IN (SELECT id FROM batch)"
+    SELECT_OCCURRENCES = "SELECT id, captured_at, path, time, location FROM occurrences WHERE id IN (SELECT id FROM batch) ORDER BY captured_at"
+
+    # Section keys - the section a text was first stored as, within an app, window and day
+    CREATE_SECTION_KEYS = """
+        CREATE TABLE IF NOT EXISTS section_keys (
+            key TEXT PRIMARY KEY,
+            id TEXT
+        )
+    """
+
+    CREATE_SECTION_KEYS_INDEX = (
+        "CREATE INDEX IF NOT EXISTS section_key_id ON section_keys(id)"
+    )
+    HAS_SECTION_KEYS = "SELECT count(*) FROM sqlite_master WHERE name = 'section_keys'"
+    INSERT_SECTION_KEY = "INSERT OR IGNORE INTO section_keys VALUES (?, ?)"
+    DELETE_SECTION_KEYS = "DELETE FROM section_keys WHERE id IN (SELECT id FROM batch)"
+    SELECT_SECTION_KEYS = (
+        "SELECT key, id FROM section_keys WHERE key IN (SELECT id FROM batch)"
+    )
+    STREAM_KEYED_SECTIONS = "SELECT id, text, app_name, window_name, captured_at FROM sections WHERE is_transcription = 0 AND text IS NOT NULL ORDER BY indexid"
+    WHITESPACE_REGEX = re.compile(r"\s+")
+
     # Queries
     SELECT_IDS = "SELECT indexid, id FROM sections WHERE id in (SELECT id FROM batch)"
     COUNT_IDS = "SELECT count(indexid) FROM sections"
+    COUNT_INDEXIDS = "SELECT count(indexid) FROM sections WHERE indexid >= ? AND indexid < ?"
 
     # Partial sql clauses
     TABLE_CLAUSE = (
@@ -108,55 +150,62 @@ class FileDB(Database):
     )
     IDS_CLAUSE = "s.indexid in (SELECT indexid from batch WHERE batch=%s)"
 
-    # EXTERNAL_TABLE = "sections"
-    # EXTERNAL_TABLE_ID = "indexid"
-    # FTS_TABLE = "sections_fts"
-
-    # DROP_FTS_SCRIPTS = [
-    #     f"DROP TRIGGER IF EXISTS {EXTERNAL_TABLE}_ai",
-    #     f"DROP TRIGGER IF EXISTS {EXTERNAL_TABLE}_ad",
-    #     f"DROP TRIGGER IF EXISTS {EXTERNAL_TABLE}_au",
-    #     f"DROP TABLE IF EXISTS {FTS_TABLE}",
-    # ]
-
-    # CREATE_FTS_SCRIPTS = [
-    #     f"""
-    #     CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
-    #         text,
-    #         app_name,
-    #         window_name,
-    #         captured_at,
-    #         tags UNINDEXED,
-    #         content='{EXTERNAL_TABLE}',
-    #         content_rowid='{EXTERNAL_TABLE_ID}',
-    #         prefix='7 10'
-    #     )
-    #     """,
-    #     f"""
-    #     CREATE TRIGGER {EXTERNAL_TABLE}_ai AFTER INSERT ON {EXTERNAL_TABLE}
-    #         BEGIN
-    #             INSERT INTO {FTS_TABLE} (rowid, text, app_name, window_name, captured_at, tags)
-    #             VALUES (new.{EXTERNAL_TABLE_ID}, new.text, new.app_name, new.window_name, new.captured_at, new.tags);
-    #         END;
-    #     """,
-    #     f"""
-    #     CREATE TRIGGER {EXTERNAL_TABLE}_ad AFTER DELETE ON {EXTERNAL_TABLE}
-    #         BEGIN
-    #             INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, text, app_name, window_name, captured_at, tags)
-    #             VALUES ('delete', old.{EXTERNAL_TABLE_ID}, old.text, old.app_name, old.window_name, old.captured_at, old.tags);
-    #         END
-    #     """,
-    #     f"""
-    #     CREATE TRIGGER {EXTERNAL_TABLE}_au AFTER UPDATE ON {EXTERNAL_TABLE}
-    #         BEGIN
-    #             INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, text, app_name, window_name, captured_at, tags)
-    #             VALUES ('delete', old.{EXTERNAL_TABLE_ID}, old.text, old.app_name, old.window_name, old.captured_at, old.tags);
-    #             INSERT INTO {FTS_TABLE} (rowid, text, app_name, window_name, captured_at, tags)
-    #             VALUES (new.{EXTERNAL_TABLE_ID}, new.text, new.app_name, new.window_name, new.captured_at, new.tags);
-    #         END
-    #     """,
-    #     f"INSERT INTO {FTS_TABLE}(rowid, text, app_name, window_name, captured_at, tags) SELECT indexid, text, app_name, window_name, captured_at, tags FROM {EXTERNAL_TABLE}",
-    # ]
+    # Keyword index - full text search over section text, kept in sync by triggers
+    EXTERNAL_TABLE = "sections"
+    EXTERNAL_TABLE_ID = "indexid"
+    FTS_TABLE = "sections_fts"
+
+    DROP_FTS_SCRIPTS = [
+        f"DROP TRIGGER IF EXISTS {EXTERNAL_TABLE}_ai",
+        f"DROP TRIGGER IF EXISTS {EXTERNAL_TABLE}_ad",
+        f"DROP TRIGGER IF EXISTS {EXTERNAL_TABLE}_au",
+        f"DROP TABLE IF EXISTS {FTS_TABLE}",
+    ]
+
+    CREATE_FTS_SCRIPTS = [
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+            text,
+            content='{EXTERNAL_TABLE}',
+            content_rowid='{EXTERNAL_TABLE_ID}'
+        )
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {EXTERNAL_TABLE}_ai AFTER INSERT ON {EXTERNAL_TABLE}
+            BEGIN
+                INSERT INTO {FTS_TABLE} (rowid, text)
+                VALUES (new.{EXTERNAL_TABLE_ID}, new.text);
+            END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {EXTERNAL_TABLE}_ad AFTER DELETE ON {EXTERNAL_TABLE}
+            BEGIN
+                INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, text)
+                VALUES ('delete', old.{EXTERNAL_TABLE_ID}, old.text);
+            END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {EXTERNAL_TABLE}_au AFTER UPDATE ON {EXTERNAL_TABLE}
+            BEGIN
+                INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, text)
+                VALUES ('delete', old.{EXTERNAL_TABLE_ID}, old.text);
+                INSERT INTO {FTS_TABLE} (rowid, text)
+                VALUES (new.{EXTERNAL_TABLE_ID}, new.text);
+            END
+        """,
+    ]
+
+    HAS_FTS = f"SELECT count(*) FROM sqlite_master WHERE name = '{FTS_TABLE}'"
+    TERMS_REGEX = re.compile(r"\w+")
+    REBUILD_FTS = f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')"
+    # bm25() is lower for better matches
+    SELECT_KEYWORD = f"SELECT rowid, -bm25({FTS_TABLE}) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH ? ORDER BY bm25({FTS_TABLE}) LIMIT ?"
+    # Term statistics of the keyword index, one row per term with the rows and times it occurs in
+    CREATE_FTS_VOCAB = f"CREATE VIRTUAL TABLE IF NOT EXISTS temp.{FTS_TABLE}_vocab USING fts5vocab(main, {FTS_TABLE}, row)"
+    SELECT_FTS_VOCAB = f"SELECT doc, cnt FROM temp.{FTS_TABLE}_vocab"
+    COUNT_SECTIONS = f"SELECT count(*) FROM {EXTERNAL_TABLE}"
+    # fts5 bm25() parameters
+    BM25_K1 = 1.2
 
     def __init__(self, config):
         """
@@ -173,6 +222,9 @@ class FileDB(Database):
         self.cursor = None
         self.path = None
 
+        # Average keyword score, computed again after sections change
+        self.averagescore = None
+
     def load(self, path):
         # Load an existing database. Thread locking must be handled externally.
         self.connection = self.connect(path)
@@ -182,6 +234,15 @@ class FileDB(Database):
         # Register custom functions
         self.addfunctions()
 
+        # Indexes created before occurrences were tracked
+        self.createoccurrences()
+
+        # Indexes created before keyword search
+        self.createfts()
+
+        # Indexes created before texts were stored once
+        self.createsectionkeys()
+
     def insert(self, documents, index=0):
         # Initialize connection if not open
         self.initialize()
@@ -211,6 +272,8 @@ class FileDB(Database):
                 self.insertsection(index, uid, document, tags, entry, meta)
                 index += 1
 
+        self.averagescore = None
+
     def delete(self, ids):
         if self.connection:
             # Batch ids
@@ -220,6 +283,9 @@ class FileDB(Database):
             self.cursor.execute(FileDB.DELETE_DOCUMENTS)
             self.cursor.execute(FileDB.DELETE_OBJECTS)
             self.cursor.execute(FileDB.DELETE_SECTIONS)
+            self.cursor.execute(FileDB.DELETE_OCCURRENCES)
+            self.cursor.execute(FileDB.DELETE_SECTION_KEYS)
+            self.averagescore = None
 
     def reindex(self, columns=None):
         if self.connection:
@@ -250,10 +316,11 @@ class FileDB(Database):
             self.cursor.execute(FileDB.RENAME_SECTIONS % name)
             self.cursor.execute(FileDB.CREATE_SECTIONS_INDEX)
             self.cursor.execute(FileDB.CREATE_SECTIONS_PATH_INDEX)
-            # for script in FileDB.DROP_FTS_SCRIPTS:
-            #     self.cursor.execute(script)
-            # for script in FileDB.CREATE_FTS_SCRIPTS:
-            #     self.cursor.execute(script)
+            if self.haskeyword():
+                for script in FileDB.DROP_FTS_SCRIPTS:
+                    self.cursor.execute(script)
+                self.createfts()
+            self.averagescore = None
 
     def save(self, path):
         # Temporary database
@@ -464,10 +531,209 @@ class FileDB(Database):
             self.cursor.execute(FileDB.CREATE_SECTIONS % "sections")
             self.cursor.execute(FileDB.CREATE_SECTIONS_INDEX)
             self.cursor.execute(FileDB.CREATE_SECTIONS_PATH_INDEX)
-            # for script in FileDB.DROP_FTS_SCRIPTS:
-            #     self.cursor.execute(script)
-            # for script in FileDB.CREATE_FTS_SCRIPTS:
-            #     self.cursor.execute(script)
+            self.createoccurrences()
+            self.createfts()
+            self.createsectionkeys()
+
+    def createoccurrences(self):
+        """
+        Creates the occurrences table if it doesn't exist.
+        """
+
+        self.cursor.execute(FileDB.CREATE_OCCURRENCES)
+        self.cursor.execute(FileDB.CREATE_OCCURRENCES_INDEX)
+
+    def createsectionkeys(self):
+        """
+        Creates the section keys table if it doesn't exist and keys the existing sections.
+        """
+
+        self.cursor.execute(FileDB.HAS_SECTION_KEYS)
+        exists = self.cursor.fetchone()[0] > 0
+        self.cursor.execute(FileDB.CREATE_SECTION_KEYS)
+        self.cursor.execute(FileDB.CREATE_SECTION_KEYS_INDEX)
+        if not exists:
+            self.cursor.execute(FileDB.STREAM_KEYED_SECTIONS)
+            keys = [
+                (FileDB.sectionkey(text, app_name, window_name, captured_at), uid)
+                for uid, text, app_name, window_name, captured_at in self.cursor.fetchall()
+            ]
+            self.cursor.executemany(FileDB.INSERT_SECTION_KEY, keys)
+
+    @staticmethod
+    def sectionkey(text, app_name, window_name, captured_at):
+        """
+        Builds the key sections of the same text are stored once under.
+
+        Args:
+            text: section text
+            app_name: app the text was captured in
+            window_name: window the text was captured in
+            captured_at: capture time as an ISO string
+
+        Returns:
+            key
+        """
+
+        text = FileDB.WHITESPACE_REGEX.sub(" ", text).strip().lower()
+        return "\t".join([captured_at[:10], app_name, window_name or "unknown", text])
+
+    def sectionids(self, keys):
+        """
+        Looks up the sections stored under a list of keys.
+
+        Args:
+            keys: list of section keys
+
+        Returns:
+            dict of key to id
+        """
+
+        if not self.connection or not keys:
+            return {}
+
+        self.batch(ids=keys)
+        self.cursor.execute(FileDB.SELECT_SECTION_KEYS)
+        return dict(self.cursor.fetchall())
+
+    def haskeyword(self):
+        """
+        Checks if the keyword index is enabled for this database.
+
+        Returns:
+            True if sections are indexed for keyword search, False otherwise
+        """
+
+        return self.config.get("keyword_backend") == "fts5"
+
+    def createfts(self):
+        """
+        Creates the keyword index if it's enabled and doesn't exist. Existing sections are indexed
+        once, the triggers keep the index in sync afterwards.
+        """
+
+        if not self.haskeyword():
+            return
+
+        self.cursor.execute(FileDB.HAS_FTS)
+        exists = self.cursor.fetchone()[0] > 0
+        for script in FileDB.CREATE_FTS_SCRIPTS:
+            self.cursor.execute(script)
+        if not exists:
+            self.cursor.execute(FileDB.REBUILD_FTS)
+
+    def keyword(self, text, limit):
+        """
+        Runs a keyword search over section text.
+
+        Args:
+            text: query text
+            limit: maximum results
+
+        Returns:
+            list of (indexid, bm25 score), best match first
+        """
+
+        if not self.connection or not self.haskeyword():
+            return []
+
+        # Quote every term, fts5 query syntax isn't exposed to users. Any term can match.
+        terms = FileDB.TERMS_REGEX.findall(text.lower())
+        if not terms:
+            return []
+
+        self.cursor.execute(
+            FileDB.SELECT_KEYWORD, [" OR ".join(f'"{x}"' for x in terms), limit]
+        )
+        return self.cursor.fetchall()
+
+    def keywordaverage(self):
+        """
+        Computes the bm25 score of an average term in a document of average length, the way
+        txtai's scoring does, with the idf fts5 ranks by.
+
+        Returns:
+            average keyword score, 0 if nothing is indexed
+        """
+
+        if not self.connection or not self.haskeyword():
+            return 0.0
+
+        if self.averagescore is None:
+            self.cursor.execute(FileDB.COUNT_SECTIONS)
+            total = self.cursor.fetchone()[0]
+            self.cursor.execute(FileDB.CREATE_FTS_VOCAB)
+            self.cursor.execute(FileDB.SELECT_FTS_VOCAB)
+            terms, tokens, idfs = 0, 0, 0.0
+            for docs, count in self.cursor:
+                terms += 1
+                tokens += count
+                # fts5 floors the idf of terms in more than half the rows
+                idfs += max(math.log((total - docs + 0.5) / (docs + 0.5)), 1e-6)
+
+            if terms == 0:
+                self.averagescore = 0.0
+            else:
+                # the average document length cancels out of the bm25 length normalization
+                frequency = tokens / terms
+                self.averagescore = (
+                    (idfs / terms)
+                    * (frequency * (FileDB.BM25_K1 + 1))
+                    / (frequency + FileDB.BM25_K1)
+                )
+
+        return self.averagescore
+
+    def insertoccurrences(self, occurrences):
+        """
+        Inserts repeated sightings of already indexed sections.
+
+        Args:
+            occurrences: list of (id, captured_at, path, time, location)
+        """
+
+        entry = datetime.datetime.now()
+        self.cursor.executemany(
+            FileDB.INSERT_OCCURRENCE,
+            [
+                (uid, captured_at, path, time, json.dumps(location), entry)
+                for uid, captured_at, path, time, location in occurrences
+            ],
+        )
+
+    def hassections(self, index, count):
+        """
+        Checks if every section in an index id range is stored.
+
+        Args:
+            index: first index id
+            count: number of index ids
+
+        Returns:
+            True if all sections are stored, False otherwise
+        """
+
+        self.cursor.execute(FileDB.COUNT_INDEXIDS, [index, index + count])
+        return self.cursor.fetchone()[0] == count
+
+    def occurrences(self, ids):
+        """
+        Retrieves the occurrences of a list of ids.
+
+        Args:
+            ids: list of ids
+
+        Returns:
+            list of dict with id, captured_at, path, time and location
+        """
+
+        if not ids:
+            return []
+
+        self.batch(ids=ids)
+        self.cursor.execute(FileDB.SELECT_OCCURRENCES)
+        columns = [c[0] for c in self.cursor.description]
+        return [dict(zip(columns, row)) for row in self.cursor.fetchall()]
 
     def insertdocument(self, uid, document, tags, entry):
         """
@@ -560,6 +826,21 @@ class FileDB(Database):
             ],
         )
 
+        # Transcriptions are read back by path, every segment is kept
+        if text and not tags_json["is_transcription"]:
+            self.cursor.execute(
+                FileDB.INSERT_SECTION_KEY,
+                [
+                    FileDB.sectionkey(
+                        text,
+                        tags_json["app_name"],
+                        tags_json["window_name"],
+                        tags_json["captured_at"],
+                    ),
+                    uid,
+                ],
+            )
+
     def defaults(self):
         """
         Returns a list of default columns when there is no select clause.
@@ -1,18 +1,32 @@
+from contextlib import contextmanager, nullcontext
+from hashlib import sha1
 import json
+import os
 import pickle
+import shutil
+import tempfile
 import threading
 import time
 
+import numpy as np
 from pydantic import BaseModel
 from txtai.embeddings import Embeddings
 import traceback
 
-from .utils.query import short_query_to_long_passage
-
-from .utils.pos import POSResult
+from .utils.query import ParsedQuery
 from .logger import logger
 
+from .custom_sqlite.filedb import FileDB
 from .custom_sqlite.sqlite import SQLite
+from .utils.embedding_cache import EmbeddingCache
+from .utils.encoder import CachedEncoder
+from .utils.cursors import SearchCursors
+from .utils.filtered_search import filtered_candidates, filtered_search
+from .utils.lru import LRUCache
+from .utils.onnx_encoder import OnnxEncoder, load_onnx_vectors
+from .utils.scheduler import scheduler
+from .utils.segments import SegmentLog
+from .utils.vectors import VectorStore, train_index
 
 # from .utils.db import TxtaiDatabase
 from .utils.state import (
@@ -20,6 +34,7 @@ from .utils.state import (
     get_embeddings,
     set_embeddings,
     set_is_deleting,
+    set_last_search_timestamp,
     state,
 )
 import re
@@ -39,38 +54,621 @@ memory_lock = threading.RLock()
 
 deleting = False
 
+EMBEDDING_MODEL = "BAAI/bge-small-en"
+# segments are merged into a full save once either limit is reached
+COMPACT_SEGMENTS = 50
+COMPACT_ROWS = 50_000
+# queries run on a second copy of every index, so they never wait for ingestion. Without it
+# queries share the writer and wait for memory_lock, halving the memory the indexes take.
+SEPARATE_SNAPSHOTS = True
+# docs upserted per slice of ingestion work, searches only wait for one slice
+SUB_BATCH_SIZE = 64
+# memories are sharded by the month they were captured in, "YYYY-MM"
+month_regex = re.compile(r"\d{4}-\d{2}")
+LEGACY_SHARD = "legacy"
+# ids of repeated texts stored as occurrences, occurrences found by frame deduplication that
+# reference them are moved to the stored memory. Frames are only compared with the last frame.
+ALIAS_CACHE_SIZE = 50_000
+# "torch" runs the sentence-transformers model, "onnx" runs the export of the same model in
+# ONNX_MODEL_PATH, int8 quantized if model_quantized.onnx was exported
+ENCODER_BACKEND = "torch"
+ONNX_MODEL_PATH = "./models/bge-small-en-onnx"
+# indexes of at least QUANTIZE_MIN_ROWS rows store vectors as 8 bit scalars, 4x smaller than
+# float32. None keeps float32. Smaller indexes stay float32, the scalar ranges are trained on
+# every row once the index is compacted, and trained again when it grew RETRAIN_GROWTH times.
+VECTOR_QUANTIZE = 8
+QUANTIZE_MIN_ROWS = 10_000
+RETRAIN_GROWTH = 4
+SELECT_INDEXIDS = "select indexid from sections order by indexid"
+EMBEDDING_CONFIG = {
+    "method": "sentence-transformers",
+    "path": EMBEDDING_MODEL,
+    "content": "src.custom_sqlite.sqlite.SQLite",
+    # keyword scores come from the sqlite fts5 index instead of txtai's in-memory scoring.
+    # txtai doesn't read keyword_backend, "keyword" would make it build its bm25 scoring too.
+    # Indexes saved with hybrid=True keep using txtai's scoring
+    "hybrid": False,
+    "keyword_backend": "fts5",
+    # new indexes start float32, see VECTOR_QUANTIZE
+    "faiss": {},
+    "gpu": False,
+    # "functions": [{"name": "graph", "function": "graph.attribute"}],
+    # "expressions": [
+    #     {"name": "topic", "expression": "graph(indexid, 'topic')"},
+    #     {"name": "topicrank", "expression": "graph(indexid, 'topicrank')"},
+    # ],
+    # "graph": {"topics": {}},
+}
+SEARCH_RESULT_CACHE_SIZE = 32
+# results are ranked once per search and paged from a cursor, a new search only fetches the first
+# pages and paging past them fetches again with twice the limit, up to SEARCH_LIMIT
+PAGE_SIZE = 20 * 8
+FIRST_SEARCH_LIMIT = PAGE_SIZE * 2
+SEARCH_LIMIT = PAGE_SIZE * 5
+CURSOR_TTL_SECONDS = 10 * 60
+CURSOR_MAX_ROWS = SEARCH_LIMIT * 10
+
+# (query, weights) -> (snapshot version, results), results of older snapshots are never served
+search_results = LRUCache(SEARCH_RESULT_CACHE_SIZE)
+search_cursors = SearchCursors(CURSOR_TTL_SECONDS, CURSOR_MAX_ROWS)
+
+
+class Snapshot:
+    """
+    An index instance published for queries, with the lock that serializes the queries on it.
+    """
+
+    instance: Embeddings
+    lock: threading.Lock
+    # publish count when the snapshot was published, results found on it are stamped with it
+    version: int
+
+    def __init__(self, instance: Embeddings, version: int):
+        self.instance = instance
+        self.lock = threading.Lock()
+        self.version = version
+
+
+def detach_terms(instance: Embeddings, path: str):
+    """
+    Moves the term index of an instance to a private file. Every instance writes its own terms,
+    the file in the index directory only changes on a full save.
+    """
+    if not instance.issparse():
+        return
+
+    terms = instance.scoring.terms
+    if terms.path and terms.path != f"{path}/scoring.terms":
+        return
+
+    handle, private_path = tempfile.mkstemp(suffix=".terms")
+    os.close(handle)
+    connection = terms.copy(private_path)
+    terms.connection.close()
+    terms.connection = connection
+    terms.cursor = connection.cursor()
+    terms.path = private_path
+
+
+def close_instance(instance: Embeddings):
+    terms_path = instance.scoring.terms.path if instance.issparse() else None
+    instance.close()
+    if terms_path and terms_path.startswith(tempfile.gettempdir()):
+        os.remove(terms_path)
+
 
 class Embedding:
-    path: str
+    """
+    Keeps two instances of the index. Queries run against the published snapshot while
+    ingestion writes to the other instance under memory_lock. After every commit the two swap,
+    and the previous snapshot replays the writes it missed before it takes writes itself.
+    With SEPARATE_SNAPSHOTS off the writer is published itself and queried under memory_lock.
+    """
+
+    path: str | None
+    # written by ingestion, only queried without SEPARATE_SNAPSHOTS
     instance: Embeddings
+    published: Snapshot | None
+    segments: SegmentLog | None
+    # full precision vectors, the quantizer is trained on them and the vector candidates of a
+    # quantized index are rescored with them
+    vectors: VectorStore | None
+    # (offset, documents, vectors) upserted since the last commit
+    pending: list[tuple[int, list, np.ndarray]]
+    # ("append", offset, documents, vectors) or ("delete", indexids) applied to the writer since the last swap
+    unpublished: list[tuple]
 
-    def __init__(self, embeddings=None):
-        self.instance = (
-            embeddings
-            if embeddings is not None
-            else Embeddings(
-                method="sentence-transformers",
-                path="BAAI/bge-small-en",
-                content="src.custom_sqlite.sqlite.SQLite",
-                hybrid=True,
-                gpu=False,
-                # functions=[{"name": "graph", "function": "graph.attribute"}],
-                # expressions=[
-                #     {"name": "topic", "expression": "graph(indexid, 'topic')"},
-                #     {"name": "topicrank", "expression": "graph(indexid, 'topicrank')"},
-                # ],
-                # graph={"topics": {}},
-            )
+    def __init__(self, path: str | None, models: dict):
+        # the vectors model is shared by every shard
+        self.instance = Embeddings(models=models, **EMBEDDING_CONFIG)
+        self.path = path
+        self.published = None
+        self.segments = None
+        self.pending = []
+        self.unpublished = []
+        self.needs_full_save = False
+        self.compacting = False
+        self.closed = False
+        self.version = 0
+        if path:
+            self.segments = SegmentLog(self.path)
+            if self.instance.exists(self.path):
+                self.instance.load(self.path)
+                detach_terms(self.instance, self.path)
+                self.replay(self.instance, repair=True)
+                self.published = Snapshot(
+                    self.load_instance() if SEPARATE_SNAPSHOTS else self.instance,
+                    self.version,
+                )
+            else:
+                self.segments.reset()
+
+        quantize = self.instance.config.get("faiss", {}).get("quantize")
+        self.vectors = (
+            VectorStore(f"{path}/vectors.f32")
+            if path and (quantize or VECTOR_QUANTIZE)
+            else None
         )
-        document_path = get_document_path()
-        if not document_path:
+
+    def load_instance(self) -> Embeddings:
+        """
+        Loads the saved index and its segments into a new instance.
+        """
+        instance = Embeddings()
+        # share the vectors model with the writer instead of loading a second copy
+        instance.loadvectors = lambda: self.instance.model
+        instance.load(self.path)
+        detach_terms(instance, self.path)
+        self.replay(instance)
+        return instance
+
+    def replay(self, instance: Embeddings, repair=False):
+        """
+        Applies the segments written since the last full save on top of a loaded index. With
+        repair, database rows that were lost before a commit are restored from the segments.
+        """
+        replayed = 0
+        for offset, documents, vectors in self.segments.read():
+            expected = instance.config.get("offset", 0)
+            if offset + len(documents) <= expected:
+                # already part of the last full save
+                continue
+            if offset != expected:
+                logger.error(
+                    f"segment at offset {offset} doesn't follow index offset {expected}, skipping remaining segments"
+                )
+                self.needs_full_save = True
+                break
+
+            if repair and not instance.database.hassections(offset, len(documents)):
+                # crashed after writing the segment, before committing the database
+                instance.database.insert(documents, offset)
+            instance.ann.append(vectors)
+            if instance.issparse():
+                instance.scoring.insert(documents, offset)
+            replayed += len(documents)
+
+        if replayed > 0:
+            if instance.issparse():
+                instance.scoring.index()
+            if repair:
+                instance.database.save(f"{self.path}/documents")
+            logger.info(f"replayed {replayed} docs from {len(self.segments)} segments")
+
+    def catch_up(self, instance: Embeddings, operations: list[tuple]) -> bool:
+        """
+        Applies the writes of the other instance. Returns False if the instance is out of step.
+        """
+        appended = False
+        for operation in operations:
+            if operation[0] == "delete":
+                indexids = operation[1]
+                instance.ann.delete(indexids)
+                if instance.issparse():
+                    instance.scoring.delete(indexids)
+                continue
+
+            _, offset, documents, vectors = operation
+            if offset != instance.config.get("offset", 0):
+                return False
+            instance.ann.append(vectors)
+            if instance.issparse():
+                instance.scoring.insert(documents, offset)
+            appended = True
+
+        if appended and instance.issparse():
+            instance.scoring.index()
+        return True
+
+    def append(self, offset: int | None, documents: list, vectors: np.ndarray | None):
+        if offset is None or vectors is None or len(vectors) != len(documents):
+            # a new index or an unexpected encoding, only a full save captures it
+            self.needs_full_save = True
+            return
+        self.pending.append((offset, documents, vectors))
+        self.unpublished.append(("append", offset, documents, vectors))
+
+    def replace(self, ids: list[str]):
+        """
+        Records the rows an upsert of ids is about to replace, txtai deletes them from the writer.
+        Must be called before the upsert, with memory_lock held.
+        """
+        if not self.instance.database or not self.instance.count():
+            return
+        indexids = [indexid for indexid, _ in self.instance.database.ids(ids)]
+        if len(indexids) == 0:
+            return
+        self.unpublished.append(("delete", indexids))
+        # the segment log only holds appends, the deletes are captured by a full save
+        self.needs_full_save = True
+
+    def delete(self, ids: list[str]):
+        indexids = [indexid for indexid, _ in self.instance.database.ids(ids)]
+        self.instance.delete(ids)
+        self.unpublished.append(("delete", indexids))
+        self.persist()
+        self.publish()
+
+    def commit(self):
+        """
+        Persists everything indexed since the last commit and publishes it. New vectors are
+        appended to the segment log and the database is committed, the full save runs in the
+        background once enough segments piled up.
+        """
+        if (
+            self.segments is None
+            or self.needs_full_save
+            or not self.instance.exists(self.path)
+            or not self.instance.database.path
+        ):
+            self.persist()
+            # the writer was rebuilt or diverged, the snapshot starts over from disk
+            self.publish(reload=True)
+            return
+
+        for offset, documents, vectors in self.pending:
+            self.segments.append(offset, documents, vectors)
+        self.pending = []
+        self.instance.database.save(f"{self.path}/documents")
+        self.publish()
+
+        if len(self.segments) >= COMPACT_SEGMENTS or self.segments.rows() >= COMPACT_ROWS:
+            self.compact_in_background()
+
+    def publish(self, reload=False):
+        """
+        Publishes the writer for queries. Must be called with memory_lock held, after a commit.
+        """
+        if self.segments is None:
+            return
+
+        previous = self.published
+        self.version += 1
+        if not SEPARATE_SNAPSHOTS:
+            self.published = Snapshot(self.instance, self.version)
+            self.unpublished = []
             return
-        self.path = f"{document_path}/txtai"
-        if self.instance.exists(self.path):
-            self.instance.load(self.path)
+
+        if previous is None or reload:
+            self.published = Snapshot(self.load_instance(), self.version)
+        else:
+            self.published = Snapshot(self.instance, self.version)
+
+        if previous is not None:
+            # wait for the queries still running on the previous snapshot
+            with previous.lock:
+                if not reload and self.catch_up(previous.instance, self.unpublished):
+                    self.instance = previous.instance
+                else:
+                    close_instance(previous.instance)
+                    if not reload:
+                        self.instance = self.load_instance()
+        self.unpublished = []
+
+    @contextmanager
+    def reading(self):
+        """
+        Yields the published instance to query, or None if nothing was indexed yet.
+        """
+        with self.reading_snapshot() as snapshot:
+            yield snapshot.instance if snapshot else None
+
+    @contextmanager
+    def reading_snapshot(self):
+        while True:
+            snapshot = self.published
+            if snapshot is None:
+                yield None
+                return
+            # a snapshot of the writer itself waits for writes, memory_lock is taken first like writers do
+            shared = memory_lock if snapshot.instance is self.instance else nullcontext()
+            with shared, snapshot.lock:
+                # a swap may have happened while waiting for the lock
+                if snapshot is self.published:
+                    yield snapshot
+                    return
 
     def persist(self):
         self.instance.save(self.path)
+        # saving a new index moves its terms into the index directory
+        detach_terms(self.instance, self.path)
+        self.pending = []
+        self.needs_full_save = False
+        if self.segments is not None:
+            self.segments.reset()
+
+    def compact_in_background(self):
+        if self.compacting:
+            return
+        self.compacting = True
+        threading.Thread(target=self.compact, name="index-compaction", daemon=True).start()
+
+    def compact(self):
+        global memory_lock
+        try:
+            scheduler.pause()
+            with memory_lock:
+                if self.closed:
+                    # the shard was dropped while waiting for the lock
+                    return
+                t0 = time.time()
+                segments = len(self.segments)
+                trained = self.train_quantizer()
+                self.persist()
+                if trained:
+                    # the snapshot still holds the previous index
+                    self.publish(reload=True)
+                logger.info(
+                    f"compacting {segments} segments took {time.time() - t0} seconds"
+                )
+        except Exception as e:
+            logger.error(f"failed to compact index {traceback.format_exc()}")
+        finally:
+            self.compacting = False
+
+    def train_quantizer(self) -> bool:
+        """
+        Rebuilds the vector index quantized, trained on the full precision vectors of every row,
+        once it has QUANTIZE_MIN_ROWS rows or grew RETRAIN_GROWTH times since it was trained.
+        Returns True if the index was rebuilt. Must be called with memory_lock held.
+        """
+        if not VECTOR_QUANTIZE or self.vectors is None or not self.instance.ann:
+            return False
+
+        settings = self.instance.config.get("faiss", {})
+        count = self.instance.ann.count()
+        trained = settings.get("trained")
+        if count < QUANTIZE_MIN_ROWS or (
+            settings.get("quantize") and trained and count < trained * RETRAIN_GROWTH
+        ):
+            return False
+
+        t0 = time.time()
+        indexids = np.array(
+            [x["indexid"] for x in self.instance.database.query_raw(SELECT_INDEXIDS)],
+            dtype=np.int64,
+        )
+        # a new dict, new shards share the settings of EMBEDDING_CONFIG
+        self.instance.config["faiss"] = {
+            **settings,
+            "quantize": VECTOR_QUANTIZE,
+            "trained": count,
+        }
+        components = None
+        if len(indexids) == count:
+            components = train_index(
+                self.instance.ann,
+                self.vectors,
+                indexids,
+                self.instance.config["dimensions"],
+            )
+        if components is None:
+            # rows indexed before their vectors were stored
+            self.instance.config["faiss"] = settings
+            logger.info(f"not quantizing {self.path}, vectors of some rows aren't stored")
+            return False
+
+        self.needs_full_save = True
+        logger.info(
+            f"trained {components} on {count} rows of {self.path} in {time.time() - t0} seconds"
+        )
+        return True
+
+    def close(self):
+        """
+        Closes both instances. Must be called with memory_lock held.
+        """
+        self.closed = True
+        snapshot = self.published
+        self.published = None
+        if snapshot is not None:
+            # wait for the queries still running on the snapshot
+            with snapshot.lock:
+                if snapshot.instance is not self.instance:
+                    close_instance(snapshot.instance)
+        close_instance(self.instance)
+
+    def stats(self):
+        return {
+            "count": self.instance.count(),
+            "segments": len(self.segments) if self.segments is not None else 0,
+            "segment_rows": self.segments.rows() if self.segments is not None else 0,
+            "snapshot_version": self.version,
+        }
+
+
+def load_vectors():
+    """
+    Loads the vectors model of the selected encoder backend, falling back to torch if the onnx
+    export or onnxruntime is missing.
+    """
+    if ENCODER_BACKEND == "onnx":
+        model = load_onnx_vectors(EMBEDDING_CONFIG, ONNX_MODEL_PATH)
+        if model is not None:
+            logger.info(f"encoding with onnx model {ONNX_MODEL_PATH}")
+            return model
+        logger.error(f"onnx model {ONNX_MODEL_PATH} unavailable, encoding with torch")
+    return Embeddings(**EMBEDDING_CONFIG).model
+
+
+def shard_key(captured_at: str) -> str:
+    key = captured_at[:7]
+    return key if month_regex.fullmatch(key) else LEGACY_SHARD
+
+
+class EmbeddingShards:
+    """
+    Routes memories to one index per month they were captured in, so date scoped searches only
+    query the months they cover and retention drops whole months. The index written before
+    sharding is kept as the legacy shard, which is queried for every date.
+    """
+
+    # replaced rather than mutated, searches iterate it without memory_lock
+    shards: dict[str, Embedding]
+    encoder: CachedEncoder
+    # bumped after shards are published or dropped, search results are stamped with it
+    generation: int
+    # shards written to since the last commit
+    dirty: set[str]
+    # memory id stored as an occurrence -> id of the memory it repeats
+    aliases: LRUCache
+
+    def __init__(self):
+        # load the vectors model once, every shard shares it through the models cache
+        model = load_vectors()
+        self.models = {EMBEDDING_MODEL: model}
+        # cached vectors of one backend aren't reused by the other
+        name = (
+            f"{EMBEDDING_MODEL}#onnx"
+            if isinstance(model.model, OnnxEncoder)
+            else EMBEDDING_MODEL
+        )
+        self.shards = {}
+        self.dirty = set()
+        self.generation = 0
+        self.aliases = LRUCache(ALIAS_CACHE_SIZE)
+        self.directory = None
+        self.legacy_path = None
+        self.queries_path = None
+        cache = None
+        document_path = get_document_path()
+        if document_path:
+            self.directory = f"{document_path}/shards"
+            self.legacy_path = f"{document_path}/txtai"
+            self.queries_path = f"{document_path}/recent_queries.json"
+            cache = EmbeddingCache(
+                f"{document_path}/embedding_cache.sqlite3", name
+            )
+
+        self.encoder = CachedEncoder(model.model, cache, name)
+        model.model = self.encoder
+
+        if document_path:
+            shards = {}
+            if os.path.isdir(self.legacy_path):
+                shards[LEGACY_SHARD] = Embedding(self.legacy_path, self.models)
+            os.makedirs(self.directory, exist_ok=True)
+            for key in sorted(os.listdir(self.directory)):
+                if month_regex.fullmatch(key):
+                    shards[key] = Embedding(f"{self.directory}/{key}", self.models)
+            self.shards = shards
+            threading.Thread(
+                target=self.warm_up, name="query-warm-up", daemon=True
+            ).start()
+
+    def warm_up(self):
+        try:
+            t0 = time.time()
+            self.encoder.warm_up(self.queries_path)
+            logger.info(f"warming up query cache took {time.time() - t0} seconds")
+        except Exception as e:
+            logger.error(f"failed to warm up query cache {traceback.format_exc()}")
+
+    def path(self, key: str) -> str | None:
+        if self.directory is None:
+            return None
+        return self.legacy_path if key == LEGACY_SHARD else f"{self.directory}/{key}"
+
+    def shard(self, key: str) -> Embedding:
+        """
+        Returns the shard of a month, creating it if needed. Must be called with memory_lock held.
+        """
+        shard = self.shards.get(key)
+        if shard is None:
+            shard = Embedding(self.path(key), self.models)
+            self.shards = {**self.shards, key: shard}
+        return shard
+
+    def select(self, start: str | None = None, end: str | None = None):
+        """
+        Returns the (key, shard) of the shards that can hold memories captured between the start
+        and end months, both inclusive.
+        """
+        return [
+            (key, shard)
+            for key, shard in sorted(self.shards.items())
+            if key == LEGACY_SHARD
+            or ((start is None or key >= start) and (end is None or key <= end))
+        ]
+
+    def commit(self):
+        for key in sorted(self.dirty):
+            shard = self.shards.get(key)
+            if shard is not None:
+                shard.commit()
+        self.dirty = set()
+        self.generation += 1
+        if self.queries_path:
+            self.encoder.save_queries(self.queries_path)
+
+    def drop(self, key: str):
+        """
+        Removes a whole shard. Must be called with memory_lock held.
+        """
+        shard = self.shards[key]
+        self.shards = {k: v for k, v in self.shards.items() if k != key}
+        self.dirty.discard(key)
+        shard.close()
+        if shard.path:
+            shutil.rmtree(shard.path, ignore_errors=True)
+
+    def retain(self, date: str) -> int:
+        """
+        Removes the memories captured before date. Months that ended before it are dropped as a
+        whole, only the month of date and the legacy shard delete memories one by one. Must be
+        called with memory_lock held.
+        """
+        removed = 0
+        month = shard_key(date)
+        for key, shard in self.select():
+            if key != LEGACY_SHARD and key < month:
+                removed += shard.instance.count()
+                self.drop(key)
+                logger.info(f"dropped shard {key}")
+
+        for key in (month, LEGACY_SHARD):
+            shard = self.shards.get(key)
+            if shard is None or not shard.instance.database:
+                continue
+            ids = shard.instance.database.query_raw(
+                f"select id from sections where captured_at < '{date}'"
+            )
+            ids = [x["id"] for x in ids]
+            if len(ids) > 0:
+                shard.delete(ids)
+                removed += len(ids)
+
+        self.generation += 1
+        return removed
+
+    def stats(self):
+        return {
+            "embedding_cache": self.encoder.cache.stats() if self.encoder.cache else None,
+            "query_cache": self.encoder.queries.stats(),
+            "generation": self.generation,
+            "aliases": self.aliases.stats(),
+            "shards": {key: shard.stats() for key, shard in self.shards.items()},
+        }
 
 
 def get_embedding():
@@ -78,21 +676,36 @@ def get_embedding():
     if state_embeddings:
         return state_embeddings
 
-    embedding = Embedding()
+    embedding = EmbeddingShards()
     set_embeddings(embedding)
     return embedding
 
 
+def get_stats():
+    embedding = get_embeddings()
+    if not embedding:
+        return {}
+
+    return {
+        **embedding.stats(),
+        "search_results": search_results.stats(),
+        "search_cursors": search_cursors.stats(),
+    }
+
+
 def get_tags():
-    global memory_lock
     embedding = get_embedding()
     if not embedding:
         return []
 
-    with memory_lock:
-        app_names = embedding.instance.search(
-            "select distinct app_name from txtai limit 300"
-        )
+    app_names = []
+    for _, shard in embedding.select():
+        with shard.reading() as instance:
+            if instance:
+                app_names += instance.search(
+                    "select distinct app_name from txtai limit 300"
+                )
+    app_names = list({x["app_name"]: x for x in app_names}.values())[:300]
 
     return [
         {"id": f"content_type#meeting", "type": "content_type", "value": "Meeting"}
@@ -103,20 +716,23 @@ def get_tags():
 
 
 def get_transcription(path: str):
-    global memory_lock
     embedding = get_embedding()
     if not embedding:
         return []
 
-    with memory_lock:
-        memories = embedding.instance.database.query_raw(
-            f"""
-            select s.id, s.text, json_extract(d.data, '$.meta') as tags 
-            from sections s
-            LEFT JOIN documents d ON s.id = d.id 
-            where path='{path}' and is_transcription=1
-            """
-        )
+    memories = []
+    for _, shard in embedding.select():
+        with shard.reading() as instance:
+            if not instance:
+                continue
+            memories += instance.database.query_raw(
+                f"""
+                select s.id, s.text, json_extract(d.data, '$.meta') as tags 
+                from sections s
+                LEFT JOIN documents d ON s.id = d.id 
+                where path='{path}' and is_transcription=1
+                """
+            )
 
     for memory in memories:
         memory["tags"] = json.loads(memory["tags"])
@@ -124,28 +740,26 @@ def get_transcription(path: str):
 
 
 def memory_search(
-    query: str,
+    parsed_query: ParsedQuery,
     tags: str | None = None,
-    date_condition: POSResult | None = None,
+    limit: int = SEARCH_LIMIT,
 ):
-    global memory_lock
-
     embedding = get_embedding()
     if not embedding:
-        return {}
+        return []
 
-    query = (
-        date_condition.clean_text
-        if date_condition and date_condition.clean_text
-        else query
-    )
+    set_last_search_timestamp()
+    query = parsed_query.text
+    date_condition = parsed_query.date_condition
 
     weights = 0.5
-    if short_query_to_long_passage(query):
+    if parsed_query.is_long_passage:
         weights = 1
         query = f"Represent this sentence for searching relevant passages: {query}"
 
     date_filter = None
+    # months the date filter covers, shards outside them can't match it
+    months = (None, None)
     if date_condition:
         date_type = date_condition.range_type
         date_reference = date_condition.parsed_date
@@ -153,10 +767,12 @@ def memory_search(
             date_filter = (
                 f"captured_at >= '{date_reference.strftime('%Y-%m-%dT00:00:00.000')}'"
             )
+            months = (date_reference.strftime("%Y-%m"), None)
         elif date_type == "before":
             date_filter = (
                 f"captured_at <= '{date_reference.strftime('%Y-%m-%dT00:00:00.000')}'"
             )
+            months = (None, date_reference.strftime("%Y-%m"))
         elif date_type == "range_week":
             date_filter = f"captured_at between '{date_condition.from_date.strftime('%Y-%m-%dT00:00:00.000')}' and '{date_condition.to_date.strftime('%Y-%m-%dT00:00:00.000')}'"
         elif date_type == "range_month":
@@ -165,6 +781,12 @@ def memory_search(
             date_filter = f"captured_at between '{date_condition.from_date.strftime('%Y-%m-%dT00:00:00.000')}' and '{date_condition.to_date.strftime('%Y-%m-%dT00:00:00.000')}'"
         elif date_type == "exact":
             date_filter = f"captured_at like '{date_reference.strftime('%Y-%m-%d')}%'"
+            months = (date_reference.strftime("%Y-%m"),) * 2
+        if date_type.startswith("range_"):
+            months = (
+                date_condition.from_date.strftime("%Y-%m"),
+                date_condition.to_date.strftime("%Y-%m"),
+            )
 
     app_name_filters = []
     content_type = ""
@@ -177,18 +799,25 @@ def memory_search(
         if memory_tag["type"] == "date_between":
             d1, d2 = memory_tag["value"].split("#")
             date_filter = f"captured_at between '{d1}' and '{d2}'"
+            months = tuple(
+                x if x != LEGACY_SHARD else None for x in (shard_key(d1), shard_key(d2))
+            )
 
-    where = "similar('{q}') and score > 0.25".format(q=query) if query else "1=1"
+    filters = []
     if date_filter:
-        where += f" and {date_filter}\n"
+        filters.append(date_filter)
     if content_type == "Meeting":
-        where += " and is_transcription=1\n"
-
+        filters.append("is_transcription=1")
     if len(app_name_filters) > 0:
-        where += f" and app_name in ({','.join(set(app_name_filters))})"
+        filters.append(f"app_name in ({','.join(set(app_name_filters))})")
 
+    where = "similar('{q}') and score > 0.25".format(q=query) if query else "1=1"
+    for condition in filters:
+        where += f" and {condition}\n"
+
+    text = query
     query = """
-        select text, score, json_group_array(meta) as rows
+        select text, score, json_group_array(meta) as rows, json_group_array(id) as ids
         from txtai
         where {where}
         group by text
@@ -196,18 +825,157 @@ def memory_search(
         limit {limit}
         """.format(
         where=where,
-        limit=20 * 8,
+        limit=limit,
     )
 
-    with memory_lock:
-        t0 = time.time()
-        search_result = embedding.instance.search(query, weights=weights)
-        t1 = time.time()
-        logger.info(f"searching took {t1-t0} seconds")
+    # the query already holds the text, tags and date condition the results depend on
+    key = (query, weights)
+    # read before searching, a shard published meanwhile makes the results stale
+    generation = embedding.generation
+    cached = search_results.get(key)
+    if cached is not None and cached[0] == generation:
+        return cached[1]
 
+    t0 = time.time()
+    search_result = []
+    with scheduler.searching():
+        for _, shard in embedding.select(*months):
+            search_result += search_shard(shard, query, text, filters, weights, limit)
+    search_result = merge_shard_results(search_result, limit)
+    logger.info(f"searching took {time.time() - t0} seconds")
+    search_results.put(key, (generation, search_result))
+
+    return search_result
+
+
+def search_shard(
+    shard: Embedding,
+    query: str,
+    text: str,
+    filters: list[str],
+    weights: float,
+    limit: int,
+):
+    with shard.reading() as instance:
+        if not instance:
+            return []
+        # narrow filters restrict the vector search to the rows matching them
+        candidates = (
+            filtered_candidates(instance, " and ".join(filters))
+            if text and len(filters) > 0
+            else None
+        )
+        # float32 indexes already score exactly
+        vectors = (
+            shard.vectors if instance.config.get("faiss", {}).get("quantize") else None
+        )
+        if candidates is not None:
+            logger.info(f"searching {len(candidates)} filtered candidates")
+            search_result = filtered_search(
+                instance, query, text, candidates, limit, weights, vectors
+            )
+        elif text and (not instance.issparse() or vectors is not None):
+            # txtai only fuses keyword scores from its own scoring, and can't rescore
+            search_result = filtered_search(
+                instance, query, text, None, limit, weights, vectors
+            )
+        else:
+            search_result = instance.search(query, weights=weights)
+        expand_occurrences(instance, search_result)
     return search_result
 
 
+def merge_shard_results(search_result: list[dict], limit: int):
+    # the same text can be found in several months, group it like a single index would
+    merged = {}
+    for result in search_result:
+        previous = merged.get(result["text"])
+        if previous is None:
+            merged[result["text"]] = result
+            continue
+        previous["rows"] = json.dumps(
+            json.loads(previous["rows"]) + json.loads(result["rows"])
+        )
+        if (result["score"] or 0) > (previous["score"] or 0):
+            previous["score"] = result["score"]
+
+    return sorted(merged.values(), key=lambda x: x["score"] or 0, reverse=True)[
+        :limit
+    ]
+
+
+def search_key(parsed_query: ParsedQuery, tags: str | None) -> str:
+    # everything the ranked results depend on, the weights follow from is_long_passage
+    date_condition = parsed_query.date_condition
+    dates = (
+        [
+            date_condition.range_type,
+            str(date_condition.parsed_date),
+            str(date_condition.from_date),
+            str(date_condition.to_date),
+        ]
+        if date_condition
+        else None
+    )
+    key = json.dumps([parsed_query.text, parsed_query.is_long_passage, dates, tags])
+    return sha1(key.encode("utf-8")).hexdigest()
+
+
+def memory_search_page(
+    parsed_query: ParsedQuery,
+    tags: str | None = None,
+    offset: int = 0,
+    cursor: str | None = None,
+) -> tuple[list, str | None]:
+    """
+    Returns a page of results and the cursor the next pages are read from. Only a new search
+    ranks results, pages of a cursor that hasn't expired are slices of the results it holds. A
+    cursor of another search is ignored, and a page past the results of a cursor that was cut at
+    its limit fetches them again with a larger one.
+    """
+    key = search_key(parsed_query, tags)
+    entry = search_cursors.get(cursor, key) if cursor else None
+    results, limit = entry if entry is not None else ([], FIRST_SEARCH_LIMIT)
+    # fewer results than the limit means every shard ran out before it
+    exhausted = entry is not None and (len(results) < limit or limit >= SEARCH_LIMIT)
+    if offset + PAGE_SIZE > len(results) and not exhausted:
+        while limit < min(offset + PAGE_SIZE, SEARCH_LIMIT):
+            limit = min(limit * 2, SEARCH_LIMIT)
+        results = memory_search(parsed_query, tags, limit)
+        if entry is not None:
+            search_cursors.update(cursor, results, limit)
+        else:
+            cursor = (
+                search_cursors.create(key, results, limit) if len(results) > 0 else None
+            )
+
+    return results[offset : offset + PAGE_SIZE], cursor
+
+
+def expand_occurrences(instance: Embeddings, search_result: list[dict]):
+    # repeated sightings of a memory are stored as occurrences, expand them into extra rows
+    ids = [id for x in search_result for id in json.loads(x["ids"])]
+    occurrences = {}
+    for occurrence in instance.database.occurrences(ids):
+        occurrences.setdefault(occurrence["id"], []).append(occurrence)
+
+    for result in search_result:
+        ids = json.loads(result.pop("ids"))
+        if not any(id in occurrences for id in ids):
+            continue
+
+        rows = json.loads(result["rows"])
+        for id, row in zip(ids, list(rows)):
+            for occurrence in occurrences.get(id, []):
+                meta = json.loads(row)
+                meta["captured_at"] = occurrence["captured_at"]
+                meta["path"] = occurrence["path"]
+                meta["time"] = occurrence["time"]
+                meta["location"] = json.loads(occurrence["location"])
+                rows.append(json.dumps(meta))
+        result["rows"] = json.dumps(rows)
+
+
 def remove_memory(date: str):
     global deleting
 
@@ -216,16 +984,10 @@ def remove_memory(date: str):
         return {}
     try:
         set_is_deleting(True)
+        logger.info(f"deleting results before date {date}")
         with memory_lock:
-            result = embedding.instance.database.query_raw(
-                f"select id from sections where captured_at < '{date}'"
-            )
-            result = [x["id"] for x in result]
-            logger.info(f"deleting {len(result)} results before date {date}")
-            if len(result) > 0:
-                embedding.instance.delete(result)
-                embedding.persist()
-        logger.info(f"deleted {len(result)} results before date {date}")
+            removed = embedding.retain(date)
+        logger.info(f"deleted {removed} results before date {date}")
     except Exception as e:
         logger.error(f"failed to delete memory {traceback.format_exc()}")
 
@@ -267,11 +1029,81 @@ class Memory(BaseModel):
         )
 
 
+class MemoryOccurrence(BaseModel):
+    id: str
+    # captured_at of the memory it repeats
+    memory_captured_at: str
+    captured_at: str
+    location: list[float]
+    screenshot_path: str
+    screenshot_time: float
+
+
+def split_repeats(database: FileDB | None, docs: list):
+    """
+    Splits docs into the docs to embed and the docs repeating a text already stored for the same
+    app, window and day. Repeats are returned as (id, occurrence row of the stored memory).
+    """
+    metas = [json.loads(document["meta"]) for _, document, _ in docs]
+    keys = []
+    for (_, document, _), meta in zip(docs, metas):
+        keys.append(
+            None
+            if meta["is_transcription"] or not document["text"]
+            else FileDB.sectionkey(
+                document["text"],
+                meta["app_name"],
+                meta["window_name"],
+                meta["captured_at"],
+            )
+        )
+
+    stored = database.sectionids([x for x in keys if x]) if database else {}
+    # a retried batch finds its own rows, they are upserted again rather than repeated
+    ids = {x[0] for x in docs}
+    stored = {key: id for key, id in stored.items() if id not in ids}
+    new_docs = []
+    repeats = []
+    for doc, meta, key in zip(docs, metas, keys):
+        if key is None:
+            new_docs.append(doc)
+            continue
+
+        stored_id = stored.get(key)
+        if stored_id is None:
+            # later docs of the batch repeat this one
+            stored[key] = doc[0]
+            new_docs.append(doc)
+            continue
+
+        repeats.append(
+            (
+                doc[0],
+                (
+                    stored_id,
+                    meta["captured_at"],
+                    meta["path"],
+                    meta["time"],
+                    meta["location"],
+                ),
+            )
+        )
+
+    return new_docs, repeats
+
+
 class StoreMemory:
     memories: list[Memory]
+    occurrences: list[MemoryOccurrence]
+    upsert_seconds: float
+    # memories stored as occurrences of a text indexed before
+    repeated: int
 
     def __init__(self):
         self.memories = []
+        self.occurrences = []
+        self.upsert_seconds = 0
+        self.repeated = 0
 
     def ready(self):
         return get_embedding() is not None
@@ -279,54 +1111,165 @@ class StoreMemory:
     def add_memories(self, documents: list[Memory]):
         self.memories += documents
 
+    def add_occurrences(self, occurrences: list[MemoryOccurrence]):
+        self.occurrences += occurrences
+
     def persist(self):
+        try:
+            if self.index():
+                self.save()
+        except Exception as e:
+            logger.error(f"failed to persist memory {traceback.format_exc()}")
+
+    def index(self) -> bool:
         global memory_lock
         embedding = get_embedding()
         if not embedding:
-            return
+            return False
 
-        docs = [
-            (
-                x.id,
-                {
-                    "text": x.text,
-                    "meta": json.dumps(
-                        {
-                            "captured_at": x.captured_at,
-                            "location": x.location,
-                            "path": x.screenshot_path,
-                            "time": x.screenshot_time,
-                            "time_to": x.screenshot_time_to,
-                            "minX": x.screenshot_minX,
-                            "minY": x.screenshot_minY,
-                            "width": x.screenshot_width,
-                            "height": x.screenshot_height,
-                            "app_name": x.app_name,
-                            "window_name": x.window_name,
-                            "is_transcription": x.screenshot_time_to is not None,
-                            "url": x.url,
-                        }
-                    ),
-                },
-                None,
+        shards = {}
+        for x in self.memories:
+            shards.setdefault(shard_key(x.captured_at), []).append(
+                (
+                    x.id,
+                    {
+                        "text": x.text,
+                        "meta": json.dumps(
+                            {
+                                "captured_at": x.captured_at,
+                                "location": x.location,
+                                "path": x.screenshot_path,
+                                "time": x.screenshot_time,
+                                "time_to": x.screenshot_time_to,
+                                "minX": x.screenshot_minX,
+                                "minY": x.screenshot_minY,
+                                "width": x.screenshot_width,
+                                "height": x.screenshot_height,
+                                "app_name": x.app_name,
+                                "window_name": x.window_name,
+                                "is_transcription": x.screenshot_time_to is not None,
+                                "url": x.url,
+                            }
+                        ),
+                    },
+                    None,
+                )
             )
-            for x in self.memories
-        ]
 
-        if len(docs) == 0:
+        if len(shards) == 0 and len(self.occurrences) == 0:
+            return False
+
+        for key, docs in sorted(shards.items()):
+            for i in range(0, len(docs), SUB_BATCH_SIZE):
+                with scheduler.slice():
+                    self.upsert(embedding, key, docs[i : i + SUB_BATCH_SIZE])
+
+        if len(self.memories) > 0:
+            docs_per_second = (
+                len(self.memories) / self.upsert_seconds if self.upsert_seconds else 0
+            )
+            logger.info(
+                f"indexing {len(self.memories)} docs into {len(shards)} shards took {self.upsert_seconds} seconds, {docs_per_second} docs per second"
+            )
+            logger.info(f"embedding cache {embedding.stats()['embedding_cache']}")
+            logger.info(f"stored {self.repeated} repeated texts as occurrences")
+
+        self.index_occurrences(embedding)
+        return True
+
+    def index_occurrences(self, embedding: EmbeddingShards | None = None):
+        """
+        Records the occurrences. They reference memories that are already indexed.
+        """
+        global memory_lock
+        embedding = embedding or get_embedding()
+        if not embedding:
             return
 
-        with memory_lock:
-            try:
-                t0 = time.time()
-                embedding.instance.upsert(docs)
-                t1 = time.time()
-                logger.info(
-                    f"indexing {len(docs)} docs took {t1 - t0} seconds, {len(docs) / (t1 - t0)} docs per second"
-                )
-                embedding.persist()
-                logger.info(
-                    f"persisting {len(docs)} docs took {time.time() - t1} seconds"
+        # occurrences are stored next to the memory they repeat
+        occurrences = {}
+        for x in self.occurrences:
+            occurrences.setdefault(shard_key(x.memory_captured_at), []).append(x)
+
+        for key, occurrences in sorted(occurrences.items()):
+            rows = [
+                (
+                    embedding.aliases.get(x.id) or x.id,
+                    x.captured_at,
+                    x.screenshot_path,
+                    x.screenshot_time,
+                    x.location,
                 )
-            except Exception as e:
-                logger.error(f"failed to persist memory {traceback.format_exc()}")
+                for x in occurrences
+            ]
+            with scheduler.slice(), memory_lock:
+                shard = embedding.shards.get(key)
+                if shard is None or not shard.instance.database:
+                    # the memory was removed with its month
+                    continue
+                shard.instance.database.insertoccurrences(rows)
+                embedding.dirty.add(key)
+                logger.info(f"recorded {len(rows)} repeated memories in shard {key}")
+
+    def upsert(self, embedding: EmbeddingShards, key: str, docs: list):
+        global memory_lock
+        # encode before taking the lock, the upsert then only reads the cache
+        t0 = time.time()
+        embedding.encoder.prefetch([x[1]["text"] for x in docs])
+        self.upsert_seconds += time.time() - t0
+
+        with memory_lock:
+            # waiting for the lock, e.g. behind a compaction, isn't indexing time
+            t0 = time.time()
+            self.index_locked(embedding, key, docs)
+            self.upsert_seconds += time.time() - t0
+
+    def index_locked(self, embedding: EmbeddingShards, key: str, docs: list):
+        """
+        Upserts docs into the shard of key. Must be called with memory_lock held.
+        """
+        shard = embedding.shard(key)
+        embedding.dirty.add(key)
+        docs, repeats = split_repeats(shard.instance.database, docs)
+        if len(docs) > 0:
+            # an empty index is rebuilt from scratch instead of appended to
+            offset = (
+                shard.instance.config.get("offset", 0)
+                if shard.instance.count()
+                else None
+            )
+            if offset is None:
+                # the quantizer of an emptied index was trained on rows that are gone
+                shard.instance.config["faiss"] = dict(EMBEDDING_CONFIG["faiss"])
+            # a retried batch upserts ids that are already stored
+            shard.replace([x[0] for x in docs])
+            with embedding.encoder.caching(counted=False) as encoded:
+                shard.instance.upsert(docs)
+            vectors = None
+            if len(encoded) > 0:
+                vectors = np.concatenate(encoded)
+                shard.instance.normalize(vectors)
+                if shard.vectors is not None and len(vectors) == len(docs):
+                    shard.vectors.write(offset or 0, vectors, reset=offset is None)
+            shard.append(offset, docs, vectors)
+
+        if len(repeats) > 0:
+            shard.instance.database.insertoccurrences(
+                [occurrence for _, occurrence in repeats]
+            )
+            for id, occurrence in repeats:
+                embedding.aliases.put(id, occurrence[0])
+            self.repeated += len(repeats)
+
+    def save(self):
+        global memory_lock
+        embedding = get_embedding()
+        if not embedding:
+            return
+
+        with scheduler.slice(), memory_lock:
+            t0 = time.time()
+            embedding.commit()
+            logger.info(
+                f"persisting {len(self.memories)} docs, {len(self.occurrences)} occurrences took {time.time() - t0} seconds"
+            )
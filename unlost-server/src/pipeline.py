@@ -0,0 +1,325 @@
+import threading
+import time
+import traceback
+from queue import Empty, Full, Queue
+from typing import cast
+
+from src.logger import logger
+from src.memory import Memory, MemoryOccurrence, StoreMemory
+from src.process_screenshots import (
+    screenshot_to_boxes,
+    split_screenshots,
+    transcription_to_memory,
+)
+from src.utils.batching import BatchSizer
+from src.utils.boxes import ScreenshotBoxes
+from src.utils.db import ScreenshotDatabase
+from src.utils.dedup import OcrDeduplicator
+from src.utils.scheduler import scheduler
+from src.utils.state import get_document_path, get_migration_state, state
+from src.utils.transform_memory import shutdown_executor, transform_memories
+
+# a partial batch is processed once its oldest screenshot has waited this long
+MAX_WAIT_SECONDS = 60
+POLL_SECONDS = 1
+# an empty queue is polled half as often each time, up to this, until screenshots arrive or a wake
+IDLE_POLL_SECONDS = 16
+RETRY_AFTER_SECONDS = 60
+QUEUE_SIZE = 2
+
+
+class Batch:
+    screenshots: list[dict]
+    ids: list[int]
+    # ocr boxes of the normal screenshots, turned into memories once they're embedded
+    boxes: list[ScreenshotBoxes]
+    memories: list[Memory]
+    # (screenshot boxes, [(memory id, memory captured_at, location)]) of the repeated boxes,
+    # MemoryOccurrence objects are only built to be stored
+    occurrences: list[tuple[ScreenshotBoxes, list[tuple]]]
+
+    def __init__(self, screenshots: list[dict]):
+        self.screenshots = screenshots
+        self.ids = [x["id"] for x in screenshots]
+        self.boxes = []
+        self.memories = []
+        self.occurrences = []
+
+
+def to_occurrences(
+    occurrences: list[tuple[ScreenshotBoxes, list[tuple]]]
+) -> list[MemoryOccurrence]:
+    return [
+        MemoryOccurrence(
+            id=id,
+            memory_captured_at=memory_captured_at,
+            captured_at=boxes.captured_at,
+            location=location,
+            screenshot_path=boxes.screenshot_path,
+            screenshot_time=boxes.screenshot_time,
+        )
+        for boxes, rows in occurrences
+        for id, memory_captured_at, location in rows
+    ]
+
+
+def can_ingest():
+    if not get_document_path():
+        return False
+    if not state["screenshot_db"]:
+        return False
+    if get_migration_state() is not None:
+        return False
+    return StoreMemory().ready()
+
+
+class IngestionPipeline:
+    """
+    Long-lived ingestion pipeline. Each stage runs on its own thread and hands batches to the next
+    stage through a bounded queue, so fetching, transforming and embedding of consecutive batches
+    overlap while a slow stage still applies backpressure upstream.
+
+    fetch -> parse -> transform -> dedup -> embed -> persist -> delete
+    """
+
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.woken = threading.Event()
+        self.parse_queue = Queue(QUEUE_SIZE)
+        self.transform_queue = Queue(QUEUE_SIZE)
+        self.dedup_queue = Queue(QUEUE_SIZE)
+        self.embed_queue = Queue(QUEUE_SIZE)
+        self.persist_queue = Queue(QUEUE_SIZE)
+        self.delete_queue = Queue(QUEUE_SIZE)
+        self.waiting_since: float | None = None
+        self.poll_seconds = POLL_SECONDS
+        self.threads: list[threading.Thread] = []
+        self.deduplicator = OcrDeduplicator()
+        self.sizer = BatchSizer()
+
+    def start(self):
+        scheduler.start()
+        stages = {
+            "fetch": self.fetch_stage,
+            "parse": lambda: self.run_stage(
+                self.parse_queue, self.parse, self.transform_queue
+            ),
+            "transform": lambda: self.run_stage(
+                self.transform_queue, self.transform, self.dedup_queue
+            ),
+            "dedup": lambda: self.run_stage(
+                self.dedup_queue, self.dedup, self.embed_queue
+            ),
+            "embed": lambda: self.run_stage(
+                self.embed_queue, self.embed, self.persist_queue
+            ),
+            "persist": self.persist_stage,
+            "delete": lambda: self.run_stage(self.delete_queue, self.delete, None),
+        }
+        for name, target in stages.items():
+            thread = threading.Thread(
+                target=target, name=f"ingestion-{name}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+        logger.info("ingestion pipeline started")
+
+    def stop(self):
+        self.stopped.set()
+        self.woken.set()
+        scheduler.stop()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        shutdown_executor()
+        logger.info("ingestion pipeline stopped")
+
+    def wake(self):
+        self.woken.set()
+
+    def put(self, queue: Queue, batch: Batch):
+        while not self.stopped.is_set():
+            try:
+                queue.put(batch, timeout=POLL_SECONDS)
+                return
+            except Full:
+                continue
+
+    def run_stage(self, in_queue: Queue, process, out_queue: Queue | None):
+        while not self.stopped.is_set():
+            try:
+                batch = in_queue.get(timeout=POLL_SECONDS)
+            except Empty:
+                continue
+
+            try:
+                process(batch)
+            except Exception as e:
+                logger.error(
+                    f"failed to {process.__name__} screenshots {traceback.format_exc()}"
+                )
+                self.release(batch)
+                continue
+
+            if out_queue is not None:
+                self.put(out_queue, batch)
+
+    def fetch_stage(self):
+        while not self.stopped.is_set():
+            try:
+                batch = self.fetch()
+            except Exception as e:
+                logger.error(f"failed to fetch screenshots {traceback.format_exc()}")
+                batch = None
+
+            if batch is None:
+                self.woken.wait(self.poll_seconds)
+                continue
+
+            self.put(self.parse_queue, batch)
+
+    def fetch(self) -> Batch | None:
+        force = self.woken.is_set()
+        self.woken.clear()
+
+        if not can_ingest():
+            return None
+
+        db = cast(ScreenshotDatabase, state["screenshot_db"])
+        unclaimed = db.count_unclaimed()
+        if unclaimed == 0:
+            self.waiting_since = None
+            self.poll_seconds = min(self.poll_seconds * 2, IDLE_POLL_SECONDS)
+            return None
+
+        self.poll_seconds = POLL_SECONDS
+        if unclaimed < self.sizer.min_size() and not force:
+            if self.waiting_since is None:
+                self.waiting_since = time.time()
+            if time.time() - self.waiting_since < MAX_WAIT_SECONDS:
+                return None
+
+        screenshots = db.claim_screenshots(self.sizer.size(unclaimed))
+        if len(screenshots) == 0:
+            self.waiting_since = None
+            return None
+
+        self.waiting_since = None
+        return Batch(screenshots)
+
+    def parse(self, batch: Batch):
+        normal_screenshots, transcription_screenshots = split_screenshots(
+            batch.screenshots
+        )
+        logger.info(
+            f"processing {len(normal_screenshots)} screenshots, {len(transcription_screenshots)} transcriptions"
+        )
+
+        batch.memories = [transcription_to_memory(x) for x in transcription_screenshots]
+        batch.boxes = [screenshot_to_boxes(x) for x in normal_screenshots]
+
+    def transform(self, batch: Batch):
+        with scheduler.slice():
+            batch.boxes = transform_memories(batch.boxes)
+
+    def dedup(self, batch: Batch):
+        # batches reach this stage in capture order, so the previous frame of a window is always known
+        new_boxes = []
+        for boxes in batch.boxes:
+            new, occurrences = self.deduplicator.deduplicate(boxes)
+            new_boxes.append(new)
+            if len(occurrences) > 0:
+                # only the screenshot fields are kept, not its boxes
+                batch.occurrences.append((boxes.empty(), occurrences))
+        batch.boxes = new_boxes
+
+    def embed(self, batch: Batch):
+        for boxes in batch.boxes:
+            batch.memories += boxes.to_memories()
+        batch.boxes = []
+        store_memory = StoreMemory()
+        store_memory.add_memories(batch.memories)
+        store_memory.index()
+        self.sizer.record(
+            len(batch.ids), len(batch.memories), store_memory.upsert_seconds
+        )
+
+    def persist_stage(self):
+        while not self.stopped.is_set():
+            try:
+                batches = [self.persist_queue.get(timeout=POLL_SECONDS)]
+            except Empty:
+                continue
+
+            # commit once for every batch embedded in the meantime
+            while True:
+                try:
+                    batches.append(self.persist_queue.get_nowait())
+                except Empty:
+                    break
+
+            try:
+                self.persist(batches)
+            except Exception as e:
+                logger.error(f"failed to persist screenshots {traceback.format_exc()}")
+                for batch in batches:
+                    self.release(batch)
+                continue
+
+            for batch in batches:
+                self.put(self.delete_queue, batch)
+
+    def persist(self, batches: list[Batch]):
+        store_memory = StoreMemory()
+        for batch in batches:
+            store_memory.add_memories(batch.memories)
+            store_memory.add_occurrences(to_occurrences(batch.occurrences))
+        # occurrences reference the memories embedded by the previous stage
+        store_memory.index_occurrences()
+        if len(store_memory.memories) > 0 or len(store_memory.occurrences) > 0:
+            store_memory.save()
+
+    def delete(self, batch: Batch):
+        db = cast(ScreenshotDatabase, state["screenshot_db"])
+        db.acknowledge_screenshots(batch.ids)
+        logger.info(f"done processing {len(batch.ids)} screenshots")
+
+    def release(self, batch: Batch):
+        # the retried screenshots must not be deduplicated against memories that were never stored
+        self.deduplicator.reset()
+        db = cast(ScreenshotDatabase, state["screenshot_db"])
+        db.release_screenshots(batch.ids, time.time() + RETRY_AFTER_SECONDS)
+
+    def stats(self):
+        db = cast(ScreenshotDatabase, state["screenshot_db"])
+        return {
+            "backlog": db.backlog if db else 0,
+            **self.sizer.stats(),
+            **scheduler.stats(),
+        }
+
+
+pipeline: IngestionPipeline | None = None
+
+
+def start_pipeline():
+    global pipeline
+    if pipeline is None:
+        pipeline = IngestionPipeline()
+        pipeline.start()
+    return pipeline
+
+
+def stop_pipeline():
+    global pipeline
+    if pipeline is not None:
+        pipeline.stop()
+        pipeline = None
+
+
+def wake_pipeline():
+    start_pipeline().wake()
+
+
+def get_pipeline_stats():
+    return pipeline.stats() if pipeline is not None else {}
@@ -0,0 +1,81 @@
+from threading import Lock
+
+from .state import get_is_search_active
+
+# seconds a batch may spend in upsert, shorter while someone is searching
+TARGET_SECONDS = 5
+INTERACTIVE_TARGET_SECONDS = 1
+# a backlog of this many batches counts as catching up, batches may then take longer
+CATCH_UP_BATCHES = 10
+CATCH_UP_FACTOR = 3
+# weight of the latest measurement in the moving averages
+SMOOTHING = 0.3
+# a batch grows by at most this factor at a time, it shrinks right away
+MAX_STEP = 2
+
+
+class BatchSizer:
+    """
+    Sizes ingestion batches from measured throughput, so a batch takes about the target time to
+    upsert whatever the machine and the screenshots look like.
+    """
+
+    def __init__(self, initial: int = 50, minimum: int = 5, maximum: int = 500):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.current = initial
+        self.lock = Lock()
+        # moving averages, None until the first batch is measured
+        self.docs_per_second: float | None = None
+        self.docs_per_screenshot: float | None = None
+
+    def record(self, screenshots: int, docs: int, seconds: float):
+        if screenshots == 0:
+            return
+
+        with self.lock:
+            self.docs_per_screenshot = self.average(
+                self.docs_per_screenshot, docs / screenshots
+            )
+            # batches that were fully deduplicated or cached say nothing about throughput
+            if docs > 0 and seconds > 0:
+                self.docs_per_second = self.average(
+                    self.docs_per_second, docs / seconds
+                )
+
+    def average(self, average: float | None, value: float):
+        if average is None:
+            return value
+        return (1 - SMOOTHING) * average + SMOOTHING * value
+
+    def target_seconds(self, backlog: int):
+        if get_is_search_active():
+            return INTERACTIVE_TARGET_SECONDS
+        if backlog > self.current * CATCH_UP_BATCHES:
+            return TARGET_SECONDS * CATCH_UP_FACTOR
+        return TARGET_SECONDS
+
+    def size(self, backlog: int = 0) -> int:
+        with self.lock:
+            if self.docs_per_second is None or not self.docs_per_screenshot:
+                return self.current
+
+            target = (
+                self.target_seconds(backlog)
+                * self.docs_per_second
+                / self.docs_per_screenshot
+            )
+            target = min(target, self.current * MAX_STEP)
+            self.current = int(min(max(target, self.minimum), self.maximum))
+            return self.current
+
+    def min_size(self):
+        # a partial batch isn't worth the fixed cost of a run until it's a tenth of a full one
+        return max(1, min(self.minimum, self.current // 10))
+
+    def stats(self):
+        return {
+            "batch_size": self.current,
+            "docs_per_second": self.docs_per_second,
+            "docs_per_screenshot": self.docs_per_screenshot,
+        }
@@ -0,0 +1,115 @@
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # src.memory imports txtai and torch, transform pool workers only need the boxes
+    from src.memory import Memory
+
+
+class ScreenshotBoxes:
+    """
+    The OCR boxes of one screenshot. Screenshot level fields are stored once and the boxes as
+    parallel lists of ids, texts and locations, Memory objects are only built to be stored.
+    """
+
+    screenshot_id: str
+    app_name: str
+    window_name: str
+    captured_at: str
+    screenshot_path: str
+    screenshot_time: float
+    screenshot_minX: float | None
+    screenshot_minY: float | None
+    screenshot_width: float
+    screenshot_height: float
+    url: str | None
+    ids: list[str]
+    texts: list[str]
+    # ocr locations, a transformed box spans one or more rectangles of 4 values each
+    locations: list[list[float]]
+
+    def __init__(
+        self,
+        screenshot_id,
+        app_name,
+        window_name,
+        captured_at,
+        screenshot_path,
+        screenshot_time,
+        screenshot_minX,
+        screenshot_minY,
+        screenshot_width,
+        screenshot_height,
+        url,
+        ids=None,
+        texts=None,
+        locations=None,
+    ):
+        self.screenshot_id = screenshot_id
+        self.app_name = app_name
+        self.window_name = window_name
+        self.captured_at = captured_at
+        self.screenshot_path = screenshot_path
+        self.screenshot_time = screenshot_time
+        self.screenshot_minX = screenshot_minX
+        self.screenshot_minY = screenshot_minY
+        self.screenshot_width = screenshot_width
+        self.screenshot_height = screenshot_height
+        self.url = url
+        self.ids = ids if ids is not None else []
+        self.texts = texts if texts is not None else []
+        self.locations = locations if locations is not None else []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, id: str, text: str, location: list[float]):
+        self.ids.append(id)
+        self.texts.append(text)
+        self.locations.append(location)
+
+    def empty(self) -> "ScreenshotBoxes":
+        """
+        Returns boxes of the same screenshot without any box.
+        """
+        return ScreenshotBoxes(
+            self.screenshot_id,
+            self.app_name,
+            self.window_name,
+            self.captured_at,
+            self.screenshot_path,
+            self.screenshot_time,
+            self.screenshot_minX,
+            self.screenshot_minY,
+            self.screenshot_width,
+            self.screenshot_height,
+            self.url,
+        )
+
+    def select(self, indices: list[int]) -> "ScreenshotBoxes":
+        boxes = self.empty()
+        for i in indices:
+            boxes.append(self.ids[i], self.texts[i], self.locations[i])
+        return boxes
+
+    def to_memories(self) -> list["Memory"]:
+        from src.memory import Memory
+
+        return [
+            Memory(
+                id=id,
+                text=text,
+                app_name=self.app_name,
+                window_name=self.window_name,
+                captured_at=self.captured_at,
+                location=location,
+                screenshot_path=self.screenshot_path,
+                screenshot_time=self.screenshot_time,
+                screenshot_time_to=None,
+                screenshot_minX=self.screenshot_minX,
+                screenshot_minY=self.screenshot_minY,
+                screenshot_width=self.screenshot_width,
+                screenshot_height=self.screenshot_height,
+                url=self.url,
+            )
+            for id, text, location in zip(self.ids, self.texts, self.locations)
+        ]
@@ -1,57 +1,113 @@
-def is_overlapping(rect1, rect2):
-    xmin1, ymin1, xmax1, ymax1 = rect1
-    xmin2, ymin2, xmax2, ymax2 = rect2
-    return (xmin1 < xmax2 and xmin2 < xmax1) and (ymin1 < ymax2 and ymin2 < ymax1)
+import numpy as np
 
 
-def is_similar(rect1, rect2, threshold):
-    xmin1, ymin1, xmax1, ymax1 = rect1
-    xmin2, ymin2, xmax2, ymax2 = rect2
+def expand_rectangles(rects: np.ndarray, threshold):
+    dx = (rects[:, 2] - rects[:, 0]) * threshold
+    dy = (rects[:, 3] - rects[:, 1]) * threshold
+    d = np.minimum(dx, dy)
+    return np.column_stack(
+        (rects[:, 0] - d, rects[:, 1] - d, rects[:, 2] + d, rects[:, 3] + d)
+    )
 
-    dy1 = ymax1 - ymin1
-    dy2 = ymax2 - ymin2
-    diff = abs(dy1 - dy2) / max(dy1, dy2)
-    return diff < threshold
 
+def candidate_pairs(rectangles: np.ndarray):
+    """
+    Sweeps the rectangles from top to bottom and pairs each one with the rectangles that start
+    before it ends. Overlapping rectangles always overlap vertically, so only these pairs need to
+    be compared, and lines of text rarely overlap vertically with more than their own row.
+    """
+    n = len(rectangles)
+    order = np.argsort(rectangles[:, 1], kind="stable")
+    ymin = rectangles[order, 1]
+    ends = np.searchsorted(ymin, rectangles[order, 3], side="left")
+    counts = np.maximum(ends - np.arange(1, n + 1), 0)
 
-def expand_rectangle(rect, threshold):
-    dx = (rect[2] - rect[0]) * threshold
-    dy = (rect[3] - rect[1]) * threshold
-    d = min(dx, dy)
-    return [rect[0] - d, rect[1] - d, rect[2] + d, rect[3] + d]
+    first = np.repeat(np.arange(n), counts)
+    # position of each pair within the run of its first rectangle
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    second = first + 1 + offsets
+    return order[first], order[second]
 
 
-def cluster_intersecting_rectangles(rects, threshold):
-    graph = {}
-    rectangles = [expand_rectangle(rect, threshold) for rect in rects]
+def adjacent_pairs(rectangles: np.ndarray, threshold):
+    """
+    Finds the pairs (i, j), i < j, of rectangles that overlap and have a similar height.
+    """
+    a, b = candidate_pairs(rectangles)
+    xmin, ymin, xmax, ymax = rectangles.T
+    heights = ymax - ymin
+
+    overlapping = (
+        (xmin[a] < xmax[b])
+        & (xmin[b] < xmax[a])
+        & (ymin[a] < ymax[b])
+        & (ymin[b] < ymax[a])
+    )
+    # rectangles of zero height never overlap, the nan of 0 / 0 is never compared
+    with np.errstate(divide="ignore", invalid="ignore"):
+        similar = (
+            np.abs(heights[a] - heights[b]) / np.maximum(heights[a], heights[b])
+            < threshold
+        )
+
+    adjacent = overlapping & similar
+    a, b = a[adjacent], b[adjacent]
+    return np.minimum(a, b), np.maximum(a, b)
 
-    for i in range(len(rectangles)):
-        graph[i] = set()
 
-    # Create the graph with overlapping rectangles
-    for i in range(len(rectangles)):
-        for j in range(i + 1, len(rectangles)):
-            if is_overlapping(rectangles[i], rectangles[j]) and is_similar(
-                rectangles[i], rectangles[j], threshold * 0.75
-            ):
-                graph[i].add(j)
-                graph[j].add(i)
+def cluster_intersecting_indices(rects, threshold) -> list[list[int]]:
+    """
+    Groups the rectangles into clusters of intersecting rectangles, each cluster is the list of
+    the indices of its rectangles.
+    """
+    if len(rects) == 0:
+        return []
+
+    rectangles = expand_rectangles(np.asarray(rects, dtype=np.float64), threshold)
+    i, j = adjacent_pairs(rectangles, threshold * 0.75)
+
+    # neighbors are added in ascending order, which gives the sets the same iteration order
+    # as when every pair was compared one by one, so clusters come out in the same order
+    nodes = np.concatenate((i, j))
+    neighbors = np.concatenate((j, i))
+    order = np.lexsort((neighbors, nodes))
+    nodes, neighbors = nodes[order].tolist(), neighbors[order].tolist()
+
+    graph = {}
+    for node in range(len(rectangles)):
+        graph[node] = set()
+    for node, neighbor in zip(nodes, neighbors):
+        graph[node].add(neighbor)
 
     clusters = []
     visited = set()
 
-    # Find connected components using Depth-First Search
-    def dfs(node, cluster):
+    # Find connected components using Depth-First Search, without recursion as dense screens
+    # have components deeper than the recursion limit
+    for node in range(len(rectangles)):
+        if node in visited:
+            continue
+
         visited.add(node)
-        cluster.append(node)
-        for neighbor in graph[node]:
-            if neighbor not in visited:
-                dfs(neighbor, cluster)
+        cluster = [node]
+        stack = [iter(graph[node])]
+        while stack:
+            for neighbor in stack[-1]:
+                if neighbor not in visited:
+                    visited.add(neighbor)
+                    cluster.append(neighbor)
+                    stack.append(iter(graph[neighbor]))
+                    break
+            else:
+                stack.pop()
 
-    for node in range(len(rectangles)):
-        if node not in visited:
-            cluster = []
-            dfs(node, cluster)
-            clusters.append([rects[node] for node in cluster])
+        clusters.append(cluster)
 
     return clusters
+
+
+def cluster_intersecting_rectangles(rects, threshold):
+    return [
+        [rects[node] for node in cluster]
+        for cluster in cluster_intersecting_indices(rects, threshold)
+    ]
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+from uuid import uuid4
+
+
+class SearchCursors:
+    """
+    Ranked search results kept between the pages of a search. A cursor expires ttl seconds after
+    it was created, and the oldest cursors are dropped once more than max_rows results are kept.
+    Each cursor holds the key of the search it was created for and is only read with that key,
+    along with the limit its results were fetched with.
+    """
+
+    def __init__(self, ttl: float, max_rows: int):
+        self.ttl = ttl
+        self.max_rows = max_rows
+        # cursor -> (created at, key, limit, results), oldest first
+        self.cursors = OrderedDict()
+        self.rows = 0
+        self.lock = Lock()
+
+    def create(self, key: str, results: list, limit: int) -> str:
+        cursor = uuid4().hex
+        with self.lock:
+            self.expire()
+            self.cursors[cursor] = (time.time(), key, limit, results)
+            self.rows += len(results)
+            self.evict(cursor)
+        return cursor
+
+    def get(self, cursor: str, key: str) -> tuple[list, int] | None:
+        """
+        Returns the results of a cursor and the limit they were fetched with, or None when the
+        cursor expired or was created for another search.
+        """
+        with self.lock:
+            self.expire()
+            entry = self.cursors.get(cursor)
+            if entry is None or entry[1] != key:
+                return None
+            return entry[3], entry[2]
+
+    def update(self, cursor: str, results: list, limit: int):
+        # results fetched again with a larger limit, the cursor keeps its age
+        with self.lock:
+            entry = self.cursors.get(cursor)
+            if entry is None:
+                return
+            self.rows += len(results) - len(entry[3])
+            self.cursors[cursor] = (entry[0], entry[1], limit, results)
+            self.evict(cursor)
+
+    def evict(self, keep: str):
+        # the cursor just written is always kept, even if it's larger than the cap on its own
+        for cursor in [x for x in self.cursors if x != keep]:
+            if self.rows <= self.max_rows:
+                break
+            self.remove(cursor)
+
+    def expire(self):
+        now = time.time()
+        while len(self.cursors) > 0:
+            cursor, (created_at, *_) = next(iter(self.cursors.items()))
+            if now - created_at < self.ttl:
+                break
+            self.remove(cursor)
+
+    def remove(self, cursor: str):
+        *_, results = self.cursors.pop(cursor)
+        self.rows -= len(results)
+
+    def stats(self):
+        return {"cursors": len(self.cursors), "rows": self.rows}
@@ -1,10 +1,23 @@
 from sqlite3 import Connection, Cursor, connect
 from datetime import datetime
+from threading import RLock
+from time import time
+
+# the incremental backlog count drifts when acknowledges race claims, it's recounted this often
+BACKLOG_RECOUNT_SECONDS = 60
 
 
 class ScreenshotDatabase:
     connection: Connection
     cursor: Cursor
+    lock: RLock
+    # (created_at, id) of the last claimed row
+    queue_position: tuple[str, int] | None
+    # screenshots waiting to be processed, counted up to counted_position
+    backlog: int
+    counted_position: tuple[str, int] | None
+    # time of the last full count of the backlog
+    counted_at: float
 
     CREATE_MIGRATIONS = """
         CREATE TABLE IF NOT EXISTS migrations (
@@ -14,6 +27,45 @@ class ScreenshotDatabase:
             done INTEGER DEFAULT 0
         )
     """
+    CREATE_CLAIMS = """
+        CREATE TABLE IF NOT EXISTS screenshot_claims (
+            id INTEGER PRIMARY KEY,
+            retry_at REAL
+        )
+    """
+    INSERT_CLAIM = "INSERT OR REPLACE INTO screenshot_claims VALUES (?, NULL)"
+    RELEASE_CLAIM = "UPDATE screenshot_claims SET retry_at = ? WHERE id = ?"
+    DELETE_CLAIM = "DELETE FROM screenshot_claims WHERE id = ?"
+    COUNT_CLAIMS = "SELECT count(*) FROM screenshot_claims WHERE retry_at IS NULL OR retry_at > ?"
+    DELETE_SCREENSHOT = "DELETE FROM screenshots WHERE id = ?"
+    # the queue is read from the screenshots_queue index alone, only the claimed rows are read from
+    # the table. The screenshots table and its indexes belong to the app, it creates this one in
+    # migration 3 of Database.swift
+    READ_QUEUE = """
+        SELECT id, created_at FROM screenshots
+        WHERE has_ocr_result = 1 {position}
+        AND id NOT IN (SELECT id FROM screenshot_claims WHERE retry_at IS NULL OR retry_at > ?)
+        ORDER BY created_at, id LIMIT ?
+    """
+
+    # columns read by ingestion, created_at must stay at index 3 and id at index 0
+    QUEUE_COLUMNS = [
+        "id",
+        "app_name",
+        "app_title",
+        "created_at",
+        "path",
+        "width",
+        "height",
+        "ocr_result",
+        "is_transcription",
+        "is_mic",
+        "screenshot_time",
+        "screenshot_time_to",
+        "url",
+        "minX",
+        "minY",
+    ]
 
     def __init__(self, document_path: str):
         self.connection = connect(
@@ -21,7 +73,14 @@ class ScreenshotDatabase:
         )
         self.connection.execute("PRAGMA journal_mode=WAL")
         self.cursor = self.connection.cursor()
+        # ingestion stages read and delete from different threads
+        self.lock = RLock()
+        self.queue_position = None
+        self.backlog = 0
+        self.counted_position = None
+        self.counted_at = 0
         self.create_migration_table()
+        self.create_claims_table()
 
     def __del__(self):
         self.connection.commit()
@@ -31,6 +90,12 @@ class ScreenshotDatabase:
     def create_migration_table(self):
         self.cursor.execute(self.CREATE_MIGRATIONS)
 
+    def create_claims_table(self):
+        self.cursor.execute(self.CREATE_CLAIMS)
+        # claims of a previous run were never acknowledged
+        self.cursor.execute("DELETE FROM screenshot_claims")
+        self.connection.commit()
+
     def create_migration(self, key: str):
         query = f"""
         INSERT INTO migrations(key, last_processed, done) 
@@ -56,32 +121,119 @@ class ScreenshotDatabase:
         done = result.fetchone()
         return done is not None and done[0] == 1
 
-    def get_screenshots_to_process(self):
-        query = "SELECT * FROM screenshots WHERE has_ocr_result = 1 ORDER BY created_at asc LIMIT 50"
-        self.cursor.execute(query)
-        columns = [c[0] for c in self.cursor.description]
-        results = []
-
-        for row in self.cursor:
-            result = {}
-
-            # Copy columns to result. In cases with duplicate column names, find one with a value
-            for x, column in enumerate(columns):
-                if column not in result or result[column] is None:
-                    result[column] = row[x]
-
-            results.append(result)
-        return results
-
-    def has_more_screenshots_to_process(self):
-        query = "SELECT count(*) FROM screenshots WHERE has_ocr_result = 1"
-        result = self.cursor.execute(query)
-        count = result.fetchone()
-        print("count", count)
-        return count[0] > 0
-
-    def delete_screenshots(self, ids: list[str]):
-        self.cursor.execute(
-            f"DELETE FROM screenshots WHERE id IN ({','.join([str(x) for x in ids])})",
-        )
-        self.connection.commit()
+    def claim_screenshots(self, limit: int = 50) -> list[dict]:
+        """
+        Claims the next screenshots to process, oldest first. Reading continues after the last
+        claimed row, and wraps around to pick up rows that were released or got their ocr result late.
+        """
+        now = time()
+        with self.lock:
+            rows = self.read_queue(limit, now)
+            if len(rows) == 0 and self.queue_position is not None:
+                self.queue_position = None
+                rows = self.read_queue(limit, now)
+                if len(rows) == 0:
+                    # nothing left to claim, correct the backlog for rows the incremental count missed
+                    self.count_backlog(full=True)
+
+            if len(rows) == 0:
+                return []
+
+            with self.connection:
+                self.connection.executemany(
+                    self.INSERT_CLAIM, [(x[0],) for x in rows]
+                )
+            self.queue_position = (rows[-1][3], rows[-1][0])
+
+        return [dict(zip(self.QUEUE_COLUMNS, x)) for x in rows]
+
+    def read_queue(self, limit: int, now: float):
+        position = ""
+        parameters = [now]
+        if self.queue_position is not None:
+            position = "AND (created_at, id) > (?, ?)"
+            parameters = list(self.queue_position) + parameters
+
+        query = self.READ_QUEUE.format(position=position)
+        ids = [
+            x[0]
+            for x in self.connection.execute(query, parameters + [limit]).fetchall()
+        ]
+        if len(ids) == 0:
+            return []
+
+        rows = self.connection.execute(
+            f"""
+            SELECT {', '.join(self.QUEUE_COLUMNS)} FROM screenshots
+            WHERE id IN ({','.join('?' * len(ids))})
+            ORDER BY created_at, id
+            """,
+            ids,
+        ).fetchall()
+        return rows
+
+    def acknowledge_screenshots(self, ids: list[int]):
+        """
+        Deletes processed screenshots and their claims in one transaction.
+        """
+        with self.lock:
+            with self.connection:
+                deleted = self.connection.executemany(
+                    self.DELETE_SCREENSHOT, [(x,) for x in ids]
+                ).rowcount
+                self.connection.executemany(self.DELETE_CLAIM, [(x,) for x in ids])
+            self.backlog = max(0, self.backlog - deleted)
+
+    def release_screenshots(self, ids: list[int], retry_at: float):
+        """
+        Releases claimed screenshots after a failure, they are claimed again after retry_at.
+        """
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(
+                    self.RELEASE_CLAIM, [(retry_at, x) for x in ids]
+                )
+            # the released rows are behind the read position
+            self.queue_position = None
+
+    def count_backlog(self, full=False):
+        """
+        Counts the screenshots waiting to be processed. Only rows after the last counted row are
+        counted, unless a full count is requested.
+        """
+        with self.lock:
+            if full:
+                self.backlog, self.counted_position = 0, None
+                self.counted_at = time()
+
+            position = ""
+            parameters = []
+            if self.counted_position is not None:
+                position = "AND (created_at, id) > (?, ?)"
+                parameters = list(self.counted_position)
+
+            count = self.connection.execute(
+                f"SELECT count(*) FROM screenshots WHERE has_ocr_result = 1 {position}",
+                parameters,
+            ).fetchone()[0]
+            if count > 0:
+                self.backlog += count
+                self.counted_position = self.connection.execute(
+                    f"""
+                    SELECT created_at, id FROM screenshots WHERE has_ocr_result = 1 {position}
+                    ORDER BY created_at DESC, id DESC LIMIT 1
+                    """,
+                    parameters,
+                ).fetchone()
+            return self.backlog
+
+    def count_unclaimed(self):
+        with self.lock:
+            backlog = self.count_backlog(
+                full=time() - self.counted_at > BACKLOG_RECOUNT_SECONDS
+            )
+            if backlog == 0:
+                # cheap while the queue is empty, and catches rows whose ocr result arrived late
+                backlog = self.count_backlog(full=True)
+            claimed = self.connection.execute(self.COUNT_CLAIMS, [time()]).fetchone()[0]
+        return max(0, backlog - claimed)
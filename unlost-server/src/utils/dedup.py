@@ -0,0 +1,95 @@
+from datetime import datetime
+import re
+
+from .boxes import ScreenshotBoxes
+
+# location coordinates are relative to the screenshot, boxes within 1% are the same box
+LOCATION_PRECISION = 100
+# a box seen for longer than this is embedded again, so date filters keep finding it
+MAX_SPAN_SECONDS = 60 * 60
+
+whitespace_regex = re.compile(r"\s+")
+
+
+def normalize_text(text: str):
+    return whitespace_regex.sub(" ", text).strip().lower()
+
+
+def approximate_location(location: list[float]):
+    return tuple(round(x * LOCATION_PRECISION) for x in location)
+
+
+def parse_captured_at(captured_at: str):
+    try:
+        return datetime.fromisoformat(captured_at)
+    except ValueError:
+        return None
+
+
+class FrameEntry:
+    memory_id: str
+    # as stored on the memory, it picks the shard the memory is in
+    memory_captured_at: str
+    first_captured_at: datetime | None
+
+    def __init__(self, memory_id, memory_captured_at, first_captured_at):
+        self.memory_id = memory_id
+        self.memory_captured_at = memory_captured_at
+        self.first_captured_at = first_captured_at
+
+
+class OcrDeduplicator:
+    """
+    Drops boxes that were already embedded from the previous frame of the same app and window.
+    A repeated box is turned into an occurrence of the memory it repeats.
+    """
+
+    # (app_name, window_name) -> (normalized text, approximate location) -> entry
+    frames: dict[tuple[str, str], dict[tuple, FrameEntry]]
+
+    def __init__(self):
+        self.frames = {}
+
+    def reset(self):
+        self.frames = {}
+
+    def deduplicate(self, boxes: ScreenshotBoxes) -> tuple[ScreenshotBoxes, list[tuple]]:
+        """
+        Deduplicates the boxes of a single screenshot against the previous screenshot of its window.
+        Screenshots must be passed in the order they were captured. Repeated boxes are returned as
+        (memory id, memory captured_at, location) occurrences of the screenshot.
+        """
+        if len(boxes) == 0:
+            return boxes, []
+
+        window = (boxes.app_name, boxes.window_name)
+        previous_frame = self.frames.get(window, {})
+        frame = {}
+        new_indices = []
+        occurrences = []
+        captured_at = parse_captured_at(boxes.captured_at)
+
+        for i, (id, text, location) in enumerate(
+            zip(boxes.ids, boxes.texts, boxes.locations)
+        ):
+            key = (normalize_text(text), approximate_location(location))
+            entry = previous_frame.get(key) or frame.get(key)
+            if entry is not None and not self.expired(entry, captured_at):
+                occurrences.append(
+                    (entry.memory_id, entry.memory_captured_at, location)
+                )
+                frame[key] = entry
+                continue
+
+            frame[key] = FrameEntry(id, boxes.captured_at, captured_at)
+            new_indices.append(i)
+
+        self.frames[window] = frame
+        if len(new_indices) == len(boxes):
+            return boxes, occurrences
+        return boxes.select(new_indices), occurrences
+
+    def expired(self, entry: FrameEntry, captured_at: datetime | None):
+        if entry.first_captured_at is None or captured_at is None:
+            return False
+        return (captured_at - entry.first_captured_at).total_seconds() > MAX_SPAN_SECONDS
@@ -0,0 +1,112 @@
+from hashlib import sha1
+from sqlite3 import connect
+from threading import Lock
+
+import numpy as np
+
+# sqlite limits the number of host parameters per statement
+CHUNK_SIZE = 500
+
+
+class EmbeddingCache:
+    """
+    Persistent, size bounded cache from text hash to embedding vector. Least recently used
+    vectors are evicted once the cache holds more than max_entries vectors.
+    """
+
+    CREATE_VECTORS = """
+        CREATE TABLE IF NOT EXISTS vectors (
+            hash TEXT PRIMARY KEY,
+            vector BLOB,
+            used INTEGER
+        )
+    """
+    CREATE_VECTORS_INDEX = "CREATE INDEX IF NOT EXISTS vectors_used ON vectors(used)"
+    INSERT_VECTOR = "INSERT OR REPLACE INTO vectors VALUES (?, ?, ?)"
+    TOUCH_VECTOR = "UPDATE vectors SET used = ? WHERE hash = ?"
+    EVICT_VECTORS = "DELETE FROM vectors WHERE hash IN (SELECT hash FROM vectors ORDER BY used LIMIT ?)"
+
+    def __init__(self, path: str, model: str, max_entries: int = 100_000):
+        self.model = model
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(self.CREATE_VECTORS)
+        self.connection.execute(self.CREATE_VECTORS_INDEX)
+        self.connection.commit()
+
+        self.count, used = self.connection.execute(
+            "SELECT count(*), max(used) FROM vectors"
+        ).fetchone()
+        # logical clock, bumped on every lookup so eviction order survives restarts
+        self.clock = used or 0
+
+    def key(self, text: str):
+        return sha1(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, texts: list[str], counted=True) -> dict[str, np.ndarray]:
+        keys = {self.key(text): text for text in texts}
+        found = {}
+        with self.lock:
+            self.clock += 1
+            hashes = list(keys.keys())
+            for i in range(0, len(hashes), CHUNK_SIZE):
+                chunk = hashes[i : i + CHUNK_SIZE]
+                rows = self.connection.execute(
+                    f"SELECT hash, vector FROM vectors WHERE hash IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                for hash, vector in rows:
+                    found[keys[hash]] = np.frombuffer(vector, dtype=np.float32)
+
+            self.connection.executemany(
+                self.TOUCH_VECTOR,
+                [(self.clock, self.key(text)) for text in found.keys()],
+            )
+            self.connection.commit()
+
+            if counted:
+                self.hits += len(found)
+                self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, vectors: dict[str, np.ndarray]):
+        if len(vectors) == 0:
+            return
+
+        with self.lock:
+            self.clock += 1
+            self.connection.executemany(
+                self.INSERT_VECTOR,
+                [
+                    (self.key(text), np.asarray(vector, dtype=np.float32).tobytes(), self.clock)
+                    for text, vector in vectors.items()
+                ],
+            )
+            self.count += len(vectors)
+            if self.count > self.max_entries:
+                # evict down to 90% so eviction doesn't run on every insert
+                self.connection.execute(
+                    self.EVICT_VECTORS,
+                    [self.count - int(self.max_entries * 0.9)],
+                )
+                self.count = self.connection.execute(
+                    "SELECT count(*) FROM vectors"
+                ).fetchone()[0]
+            self.connection.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": self.count,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+        }
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,121 @@
+from contextlib import contextmanager
+import json
+import os
+from threading import local
+
+import numpy as np
+
+from .embedding_cache import EmbeddingCache
+from .lru import LRUCache
+from .segments import write_atomic
+
+# query vectors kept in memory, and how many of the latest queries are encoded again at startup
+QUERY_CACHE_SIZE = 512
+WARM_UP_QUERIES = 64
+
+
+class CachedEncoder:
+    """
+    Stands in for the sentence-transformers model that txtai calls to encode text. Inside a
+    caching() block, vectors are served from the embedding cache and only misses reach the model.
+    Outside of it only searches encode, their queries are served from an in-memory LRU.
+    """
+
+    def __init__(self, model, cache: EmbeddingCache | None = None, name: str = ""):
+        self.model = model
+        self.cache = cache
+        self.name = name
+        # caching is enabled per thread, searches running next to ingestion bypass it
+        self.local = local()
+        # (model name, query) -> vector, passage queries carry their instruction prefix in the text
+        self.queries = LRUCache(QUERY_CACHE_SIZE)
+        self.queries_changed = False
+
+    @contextmanager
+    def caching(self, counted=True):
+        """
+        Serves vectors from the cache for the current thread. Yields the list of arrays encoded in
+        the block, in the order they were requested, so callers can persist exactly what was indexed.
+        Lookups of texts that were prefetched shouldn't count towards the cache stats.
+        """
+        self.local.caching = True
+        self.local.counted = counted
+        self.local.encoded = []
+        try:
+            yield self.local.encoded
+        finally:
+            self.local.caching = False
+            self.local.encoded = None
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        if not getattr(self.local, "caching", False):
+            return self.encode_queries(texts, batch_size, **kwargs)
+        if self.cache is None:
+            return self.model.encode(texts, batch_size, **kwargs)
+
+        vectors = self.cache.get_many(texts, counted=self.local.counted)
+        misses = list(dict.fromkeys(x for x in texts if x not in vectors))
+        if len(misses) > 0:
+            encoded = dict(zip(misses, self.model.encode(misses, batch_size, **kwargs)))
+            self.cache.put_many(encoded)
+            vectors.update(encoded)
+
+        # txtai normalizes the returned array in place, never hand out cached arrays
+        encoded = np.array([vectors[x] for x in texts], dtype=np.float32)
+        self.local.encoded.append(encoded.copy())
+        return encoded
+
+    def encode_queries(self, texts, batch_size=32, **kwargs):
+        vectors = {}
+        for text in texts:
+            vector = self.queries.get((self.name, text))
+            if vector is not None:
+                vectors[text] = vector
+
+        misses = list(dict.fromkeys(x for x in texts if x not in vectors))
+        if len(misses) > 0:
+            encoded = self.model.encode(misses, batch_size, **kwargs)
+            for text, vector in zip(misses, encoded):
+                vector = np.array(vector, dtype=np.float32)
+                self.queries.put((self.name, text), vector)
+                vectors[text] = vector
+            self.queries_changed = True
+
+        # txtai normalizes the returned array in place, never hand out cached arrays
+        return np.array([vectors[x] for x in texts], dtype=np.float32)
+
+    def save_queries(self, path: str):
+        """
+        Persists the latest queries, so warm_up can encode them again after a restart.
+        """
+        if not self.queries_changed:
+            return
+        self.queries_changed = False
+        with self.queries.lock:
+            recent = [text for name, text in self.queries.entries if name == self.name]
+        data = json.dumps({"model": self.name, "queries": recent[-WARM_UP_QUERIES:]})
+        write_atomic(path, lambda handle: handle.write(data.encode("utf-8")))
+
+    def warm_up(self, path: str):
+        if WARM_UP_QUERIES <= 0 or not os.path.exists(path):
+            return
+        with open(path, "r") as handle:
+            saved = json.load(handle)
+        if saved.get("model") != self.name:
+            return
+        queries = saved.get("queries", [])
+        encoded = self.model.encode(queries, 32) if len(queries) > 0 else []
+        for text, vector in zip(queries, encoded):
+            self.queries.put((self.name, text), np.array(vector, dtype=np.float32))
+
+    def prefetch(self, texts: list[str], batch_size=32):
+        """
+        Encodes texts into the cache ahead of an upsert, so the upsert itself only reads the cache.
+        """
+        if self.cache is None:
+            return
+        with self.caching():
+            self.encode(texts, batch_size)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
@@ -0,0 +1,171 @@
+import numpy as np
+from txtai.embeddings import Embeddings
+
+from .vectors import VectorStore
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# filters matching more than this share of the index gain little from pruning, the regular search
+# retrieves enough neighbours that survive them
+FILTERED_SEARCH_RATIO = 0.2
+# candidate sets this small are scored exactly, every ivf cell is probed
+EXACT_SEARCH_CANDIDATES = 5000
+# sparse search can't be restricted to the candidates, it over-fetches and drops the rest
+SPARSE_OVERFETCH = 10
+# keyword scores are divided by the top score plus the average score, up to this many average
+# scores, like txtai normalizes its bm25 scores
+MAX_KEYWORD_SCORE = 6
+
+SELECT_CANDIDATES = "select indexid from sections where {where}"
+
+
+def filtered_candidates(instance: Embeddings, where: str) -> np.ndarray | None:
+    """
+    Returns the indexids matching a metadata filter, or None if the filter isn't narrow enough
+    to search only them.
+    """
+    if faiss is None or not instance.ann or not hasattr(instance.ann.backend, "search"):
+        return None
+
+    rows = instance.database.query_raw(SELECT_CANDIDATES.format(where=where))
+    if len(rows) > instance.ann.count() * FILTERED_SEARCH_RATIO:
+        return None
+    return np.array([x["indexid"] for x in rows], dtype=np.int64)
+
+
+def search_parameters(backend, selector, exact: bool, nprobe: int):
+    try:
+        ivf = faiss.extract_index_ivf(backend)
+    except RuntimeError:
+        # flat indexes always score exactly
+        return faiss.SearchParameters(sel=selector)
+    return faiss.SearchParametersIVF(
+        sel=selector, nprobe=ivf.nlist if exact else nprobe
+    )
+
+
+def dense_search(
+    instance: Embeddings,
+    text: str,
+    candidates: np.ndarray | None,
+    limit: int,
+    vectors: VectorStore | None = None,
+):
+    embeddings = instance.batchtransform([(None, text, None)])
+    if candidates is None:
+        results = instance.ann.search(embeddings, limit)[0]
+    elif len(candidates) == 0:
+        return []
+    else:
+        selector = faiss.IDSelectorBatch(len(candidates), faiss.swig_ptr(candidates))
+        params = search_parameters(
+            instance.ann.backend,
+            selector,
+            len(candidates) <= EXACT_SEARCH_CANDIDATES,
+            instance.ann.nprobe(),
+        )
+        scores, ids = instance.ann.backend.search(
+            embeddings, min(limit, len(candidates)), params=params
+        )
+        results = list(zip(ids[0].tolist(), scores[0].tolist()))
+
+    if vectors is not None:
+        results = rescore(vectors, embeddings[0], results)
+    # faiss pads missing results with -1
+    return [(i, score) for i, score in results if i >= 0 and score > 0]
+
+
+def rescore(vectors: VectorStore, query: np.ndarray, results: list[tuple[int, float]]):
+    """
+    Scores the candidates of a quantized index again with their full precision vectors.
+    Candidates without a stored vector keep their quantized score.
+    """
+    results = [(i, score) for i, score in results if i >= 0]
+    if len(results) == 0:
+        return results
+
+    stored = vectors.read([i for i, _ in results], query.shape[0])
+    exact = (stored @ query).tolist()
+    written = stored.any(axis=1).tolist()
+    results = [
+        (i, exact[x] if written[x] else score) for x, (i, score) in enumerate(results)
+    ]
+    return sorted(results, key=lambda x: x[1], reverse=True)
+
+
+def sparse_search(
+    instance: Embeddings, text: str, candidates: np.ndarray | None, limit: int
+):
+    fetch = limit if candidates is None else limit * SPARSE_OVERFETCH
+    if instance.database.haskeyword():
+        results = normalize_keyword(
+            instance.database.keyword(text, fetch),
+            instance.database.keywordaverage(),
+        )
+    else:
+        results = instance.scoring.search(text, fetch) or []
+    if candidates is None:
+        return results
+
+    allowed = set(candidates.tolist())
+    return [(i, score) for i, score in results if i in allowed][:limit]
+
+
+def normalize_keyword(results: list[tuple[int, float]], average: float):
+    """
+    Scales bm25 scores to [0, 1] so they can be weighted against vector scores, with txtai's
+    formula. average is the score of an average term in the index.
+    """
+    if len(results) == 0:
+        return []
+    maxscore = min(results[0][1] + average, MAX_KEYWORD_SCORE * average)
+    if maxscore <= 0:
+        return [(i, 1.0) for i, _ in results]
+    return [(i, min(score / maxscore, 1.0)) for i, score in results]
+
+
+def haskeyword(instance: Embeddings):
+    return instance.database.haskeyword() or instance.issparse()
+
+
+def filtered_search(
+    instance: Embeddings,
+    query: str,
+    text: str,
+    candidates: np.ndarray | None,
+    limit: int,
+    weights: float,
+    vectors: VectorStore | None = None,
+):
+    """
+    Runs a database query whose similar() clause only considers the candidate indexids, or every
+    row without candidates. Scores are combined the same way txtai combines a hybrid search, the
+    keyword scores come from txtai's scoring or from the database keyword index. Quantized
+    indexes pass the store of their full precision vectors to rescore the vector candidates.
+    """
+    # similar clauses are filtered further by sql, txtai fetches 10x the limit for them
+    candidates_limit = limit * 10
+    dense = dense_search(instance, text, candidates, candidates_limit, vectors)
+    similarity = dense
+    if haskeyword(instance):
+        sparse = sparse_search(instance, text, candidates, candidates_limit)
+        scores = {}
+        for results, weight in ((dense, weights), (sparse, 1 - weights)):
+            for r, (uid, score) in enumerate(results if weight > 0 else []):
+                scores[uid] = scores.get(uid, 0.0) + (
+                    score * weight
+                    if instance.database.haskeyword()
+                    or not instance.issparse()
+                    or instance.scoring.isnormalized()
+                    else (1.0 / (r + 1)) * weight
+                )
+        similarity = sorted(scores.items(), key=lambda x: x[1], reverse=True)[
+            :candidates_limit
+        ]
+
+    return instance.database.search(
+        instance.database.parse(query), [similarity], limit
+    )
@@ -0,0 +1,121 @@
+import json
+import os
+import traceback
+
+import numpy as np
+from txtai.vectors.transformers import TransformersVectors
+
+from src.logger import logger
+
+try:
+    import onnxruntime
+    from tokenizers import Tokenizer
+except ImportError:
+    onnxruntime = None
+
+# optimum names the int8 export model_quantized.onnx, it's preferred when both are exported
+MODEL_FILES = ["model_quantized.onnx", "model.onnx"]
+MAX_LENGTH = 512
+# sentence-transformers pooling config, copied next to the export
+POOLING_CONFIG = "1_Pooling/config.json"
+POOLING_MODES = {"pooling_mode_cls_token": "cls", "pooling_mode_mean_tokens": "mean"}
+# pooling of models exported without their pooling config
+MODEL_POOLING = {"BAAI/bge-small-en": "cls"}
+
+
+def pooling_mode(path: str, model: str) -> str:
+    """
+    Returns how the token vectors of the export in path are pooled, "cls" or "mean", from its
+    pooling config or the known pooling of model.
+    """
+    if os.path.exists(f"{path}/{POOLING_CONFIG}"):
+        with open(f"{path}/{POOLING_CONFIG}") as f:
+            config = json.load(f)
+        modes = [x for x, enabled in config.items() if x.startswith("pooling_mode_") and enabled]
+        if len(modes) != 1 or modes[0] not in POOLING_MODES:
+            raise ValueError(f"unsupported pooling {modes} in {path}/{POOLING_CONFIG}")
+        return POOLING_MODES[modes[0]]
+
+    if model not in MODEL_POOLING:
+        raise ValueError(f"no {POOLING_CONFIG} in {path} and pooling of {model} unknown")
+    return MODEL_POOLING[model]
+
+
+class OnnxEncoder:
+    """
+    Encodes text with an onnx export of a sentence-transformers model, through the encode method
+    txtai calls on SentenceTransformer. Token vectors are pooled like sentence-transformers pools
+    them, the [CLS] token or the mean of the tokens, and normalized.
+    """
+
+    def __init__(self, path: str, pooling: str, model_file: str | None = None):
+        self.pooling = pooling
+        # the int8 export when both are exported, unless model_file picks one
+        model_file = (
+            f"{path}/{model_file}"
+            if model_file
+            else next(f"{path}/{x}" for x in MODEL_FILES if os.path.exists(f"{path}/{x}"))
+        )
+        self.session = onnxruntime.InferenceSession(
+            model_file, providers=["CPUExecutionProvider"]
+        )
+        self.inputs = {x.name for x in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(f"{path}/tokenizer.json")
+        self.tokenizer.enable_truncation(MAX_LENGTH)
+        self.tokenizer.enable_padding()
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        # batches of similar lengths pad less, like sentence-transformers batches them
+        order = np.argsort([-len(x) for x in texts], kind="stable")
+        texts = [texts[x] for x in order]
+        vectors = []
+        for i in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[i : i + batch_size])
+            inputs = {
+                "input_ids": np.array([x.ids for x in encodings], dtype=np.int64),
+                "attention_mask": np.array(
+                    [x.attention_mask for x in encodings], dtype=np.int64
+                ),
+                "token_type_ids": np.array(
+                    [x.type_ids for x in encodings], dtype=np.int64
+                ),
+            }
+            hidden = self.session.run(
+                None, {k: v for k, v in inputs.items() if k in self.inputs}
+            )[0]
+            if self.pooling == "cls":
+                vectors.append(hidden[:, 0])
+            else:
+                mask = inputs["attention_mask"][:, :, None].astype(hidden.dtype)
+                vectors.append((hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9))
+
+        if len(vectors) == 0:
+            return np.zeros((0, self.session.get_outputs()[0].shape[-1]), dtype=np.float32)
+        vectors = np.concatenate(vectors).astype(np.float32)[np.argsort(order)]
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class OnnxVectors(TransformersVectors):
+    """
+    txtai vectors model that encodes with OnnxEncoder instead of loading the torch model.
+    """
+
+    def load(self, path):
+        return OnnxEncoder(self.config["onnx"], pooling_mode(self.config["onnx"], path))
+
+
+def load_onnx_vectors(config: dict, path: str) -> OnnxVectors | None:
+    """
+    Returns the vectors model for the onnx export in path, or None if onnxruntime isn't
+    installed, nothing was exported there or the export can't be loaded.
+    """
+    if onnxruntime is None:
+        return None
+    if not any(os.path.exists(f"{path}/{x}") for x in MODEL_FILES):
+        return None
+    try:
+        return OnnxVectors({**config, "onnx": path}, None)
+    except Exception:
+        # a corrupt export, or one onnxruntime or the tokenizers version can't read
+        logger.error(f"failed to load onnx model {path} {traceback.format_exc()}")
+        return None
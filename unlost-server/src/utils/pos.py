@@ -13,6 +13,39 @@ nlp = get_nlp()
 
 contains_number_regex = r"\d"
 
+# words that can be part of a date or time entity, queries without any of them skip spacy
+date_signal_regex = re.compile(
+    r"\d|\b(?:"
+    r"monday|tuesday|wednesday|thursday|friday|saturday|sunday|"
+    r"mon|tue|tues|wed|thu|thur|thurs|fri|sat|sun|"
+    r"january|february|march|april|may|june|july|august|september|october|november|december|"
+    r"jan|feb|mar|apr|jun|jul|aug|sep|sept|oct|nov|dec|"
+    r"today|tonight|tomorrow|yesterday|now|ago|morning|afternoon|evening|night|noon|midnight|"
+    r"day|week|weekend|month|year|hour|minute|second|decade|century|quarter|"
+    r"daily|weekly|monthly|yearly|annual|"
+    r"spring|summer|autumn|fall|winter|christmas|easter|holiday|eve|"
+    r"last|past|previous|next|this|recent|recently|earlier|later"
+    r")s?\b",
+    re.IGNORECASE,
+)
+
+# common date expressions, found without running spacy
+units = r"(?:day|week|month|year|hour|minute)s?"
+full_weekdays = r"(?:monday|tuesday|wednesday|thursday|friday|saturday|sunday)"
+date_expression_regex = re.compile(
+    r"\b(?:"
+    r"\d{4}-\d{1,2}-\d{1,2}|"
+    rf"(?:last|past|previous) (?:\d+ )?{units}|"
+    rf"(?:last|past|previous) {full_weekdays}|"
+    rf"\d+ {units} ago|"
+    r"today|yesterday|"
+    rf"{full_weekdays}"
+    r")\b",
+    re.IGNORECASE,
+)
+
+the_regex = re.compile(r"\bthe\s+$", re.IGNORECASE)
+
 
 def contains_number(input_string):
     return bool(re.search(contains_number_regex, input_string))
@@ -69,15 +102,51 @@ class POSResult(BaseModel):
 def get_date_condition(
     sentence: str,
 ) -> POSResult | None:
+    if not date_signal_regex.search(sentence):
+        return None
+
+    date_text = rule_date_text(sentence)
+    if date_text:
+        result = parse_date_condition(sentence, date_text)
+        if result:
+            return result
+
+    # spacy only runs for the expressions the rules don't know
+    date_text = entity_date_text(sentence)
+    if not date_text:
+        return None
+
+    return parse_date_condition(sentence, date_text)
+
+
+def rule_date_text(sentence: str) -> str | None:
+    """
+    Returns the date expression of a query if the rules find exactly one, and no other date word
+    is around that spacy could make part of its entity or pick instead.
+    """
+    matches = list(date_expression_regex.finditer(sentence))
+    if len(matches) != 1:
+        return None
+
+    match = matches[0]
+    if the_regex.search(sentence[: match.start()]):
+        # spacy's entity takes the article, "the last month"
+        return None
+    for signal in date_signal_regex.finditer(sentence):
+        if signal.start() < match.start() or signal.end() > match.end():
+            return None
+    return match.group(0)
+
+
+def entity_date_text(sentence: str) -> str | None:
     doc = nlp(sentence)
-    date_text = ""
     for entity in doc.ents:
         if entity.label_ == "DATE" or entity.label_ == "TIME":
-            date_text = entity.text
-            break
-    if not date_text:
-        return None
+            return entity.text
+    return None
+
 
+def parse_date_condition(sentence: str, date_text: str) -> POSResult | None:
     identified_date_text = date_text
     range_type = "exact"
 
@@ -1,10 +1,17 @@
+from datetime import date
 import nltk
 import pickle
 
+from .lru import LRUCache
+from .pos import POSResult, get_date_condition
+
 f = open("./query_classifier.pickle", "rb")
 classifier = pickle.load(f)
 f.close()
 
+# the ui sends the same few queries again as the user types and pages
+PARSED_QUERY_CACHE_SIZE = 256
+
 
 def dialogue_act_features(post):
     features = {}
@@ -15,3 +22,39 @@ def dialogue_act_features(post):
 
 def short_query_to_long_passage(q: str) -> bool:
     return classifier.classify(dialogue_act_features(q))
+
+
+class ParsedQuery:
+    date_condition: POSResult | None
+    # the query without its date expression
+    text: str
+    is_long_passage: bool
+
+    def __init__(self, date_condition, text, is_long_passage):
+        self.date_condition = date_condition
+        self.text = text
+        self.is_long_passage = is_long_passage
+
+
+parsed_queries = LRUCache(PARSED_QUERY_CACHE_SIZE)
+
+
+def parse_query(query: str, parse_date: bool = True) -> ParsedQuery:
+    """
+    Parses the date condition out of a query and classifies what's left. Results are cached for the
+    day, relative dates such as "last week" mean something else tomorrow.
+    """
+    key = (query, parse_date, date.today())
+    parsed = parsed_queries.get(key)
+    if parsed is not None:
+        return parsed
+
+    date_condition = get_date_condition(query) if parse_date else None
+    text = (
+        date_condition.clean_text
+        if date_condition and date_condition.clean_text
+        else query
+    )
+    parsed = ParsedQuery(date_condition, text, short_query_to_long_passage(text))
+    parsed_queries.put(key, parsed)
+    return parsed
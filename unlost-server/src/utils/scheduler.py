@@ -0,0 +1,96 @@
+from contextlib import contextmanager
+from threading import Condition
+import time
+
+from src.logger import logger
+
+from .state import (
+    get_is_client_open,
+    get_is_client_open_for_more_than_1_minute,
+    set_last_client_timestamp,
+)
+
+# share of wall time ingestion may spend working, the rest it sleeps
+IDLE_DUTY_CYCLE = 0.8
+CLIENT_OPEN_DUTY_CYCLE = 0.3
+# ingestion waits for running searches at most this long, so it never stops completely
+MAX_PAUSE_SECONDS = 10
+
+
+class IngestionScheduler:
+    """
+    Hands out ingestion work in slices. Before a slice starts it waits for running searches to
+    finish, and after it ends it sleeps in proportion to the time it took so ingestion stays
+    within its share of the cpu.
+    """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.searches = 0
+        self.stopped = False
+        self.work_seconds = 0.0
+        self.pause_seconds = 0.0
+
+    def start(self):
+        with self.condition:
+            self.stopped = False
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    @contextmanager
+    def searching(self):
+        with self.condition:
+            self.searches += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.searches -= 1
+                self.condition.notify_all()
+
+    def duty_cycle(self):
+        if not get_is_client_open():
+            return IDLE_DUTY_CYCLE
+        if get_is_client_open_for_more_than_1_minute():
+            logger.warn("client is open for more than 1 minute, shouldn't happen")
+            set_last_client_timestamp(False)
+            return IDLE_DUTY_CYCLE
+        return CLIENT_OPEN_DUTY_CYCLE
+
+    def pause(self):
+        # yield to searches between slices
+        t0 = time.time()
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.searches == 0 or self.stopped, MAX_PAUSE_SECONDS
+            )
+        self.pause_seconds += time.time() - t0
+
+    def rest(self, seconds: float):
+        with self.condition:
+            self.condition.wait_for(lambda: self.stopped, seconds)
+
+    @contextmanager
+    def slice(self):
+        self.pause()
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - t0
+            self.work_seconds += elapsed
+            duty_cycle = self.duty_cycle()
+            self.rest(elapsed * (1 - duty_cycle) / duty_cycle)
+
+    def stats(self):
+        return {
+            "searches": self.searches,
+            "work_seconds": self.work_seconds,
+            "pause_seconds": self.pause_seconds,
+        }
+
+
+scheduler = IngestionScheduler()
@@ -0,0 +1,104 @@
+import json
+import os
+
+import numpy as np
+
+MANIFEST = "manifest.json"
+
+
+def write_atomic(path: str, write):
+    # write to a temporary file first, a crash never leaves a half written file behind
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as handle:
+        write(handle)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(temporary, path)
+
+
+class Segment:
+    name: str
+    offset: int
+    count: int
+
+    def __init__(self, name, offset, count):
+        self.name = name
+        self.offset = offset
+        self.count = count
+
+
+class SegmentLog:
+    """
+    Append-only log of the documents and vectors indexed since the last full save of an index.
+    The manifest lists the complete segments in order and is replaced atomically, so a segment
+    only becomes visible once it is fully written.
+    """
+
+    segments: list[Segment]
+
+    def __init__(self, path: str):
+        self.directory = f"{path}/segments"
+        self.segments = []
+        self.next_segment = 0
+
+        manifest_path = f"{self.directory}/{MANIFEST}"
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as handle:
+                manifest = json.load(handle)
+            self.segments = [Segment(**x) for x in manifest["segments"]]
+            self.next_segment = manifest["next_segment"]
+
+    def __len__(self):
+        return len(self.segments)
+
+    def rows(self):
+        return sum(x.count for x in self.segments)
+
+    def append(self, offset: int, documents: list, vectors: np.ndarray):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{self.next_segment:08d}.npz"
+        write_atomic(
+            f"{self.directory}/{name}",
+            lambda handle: np.savez(
+                handle,
+                vectors=vectors.astype(np.float32),
+                documents=np.array(json.dumps(documents)),
+            ),
+        )
+
+        self.segments.append(Segment(name, offset, len(documents)))
+        self.next_segment += 1
+        self.write_manifest()
+
+    def read(self):
+        for segment in self.segments:
+            with np.load(f"{self.directory}/{segment.name}") as data:
+                documents = [tuple(x) for x in json.loads(str(data["documents"]))]
+                yield segment.offset, documents, data["vectors"]
+
+    def reset(self):
+        """
+        Drops every segment, called once the index was saved in full.
+        """
+
+        names = [x.name for x in self.segments]
+        self.segments = []
+        if not os.path.exists(self.directory):
+            return
+
+        self.write_manifest()
+        for name in names:
+            try:
+                os.remove(f"{self.directory}/{name}")
+            except FileNotFoundError:
+                pass
+
+    def write_manifest(self):
+        manifest = {
+            "next_segment": self.next_segment,
+            "segments": [x.__dict__ for x in self.segments],
+        }
+        write_atomic(
+            f"{self.directory}/{MANIFEST}",
+            lambda handle: handle.write(json.dumps(manifest).encode("utf-8")),
+        )
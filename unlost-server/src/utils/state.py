@@ -1,8 +1,16 @@
 from datetime import datetime
+from os import cpu_count, environ
 from .db import ScreenshotDatabase
 import en_core_web_sm
 import spacy
 
+# overrides the transform pool size, 1 transforms screenshots in the pipeline thread
+TRANSFORM_WORKERS_ENV = "UNLOST_TRANSFORM_WORKERS"
+# set to 1 to find sentence boundaries with the senter component instead of the parser. Its
+# boundaries differ from the parser's, it stays off until they are compared on ocr text with
+# benchmarks/bench_segmentation.py
+SENTER_SEGMENTATION_ENV = "UNLOST_SENTER_SEGMENTATION"
+
 state = {
     "document_path": "",
     "screenshot_db": None,
@@ -10,16 +18,66 @@ state = {
     "embeddings": None,
     "last_client_opened_at": 0,
     "last_client_closed_at": 0,
+    "last_search_at": 0,
     "deleting": False,
     "migration": None,
-    "nlp": en_core_web_sm.load(),
+    # loaded on first use, transform pool workers only load the segmenter
+    "nlp": None,
+    "segmenter": None,
+    "transform_workers": max(1, (cpu_count() or 1) // 2),
 }
 
 
 def get_nlp():
+    if state["nlp"] is None:
+        state["nlp"] = en_core_web_sm.load()
     return state["nlp"]
 
 
+def get_segmenter():
+    if state["segmenter"] is None:
+        senter = environ.get(SENTER_SEGMENTATION_ENV) == "1"
+        state["segmenter"] = load_segmenter(senter)
+    return state["segmenter"]
+
+
+def load_segmenter(senter: bool):
+    """
+    Loads the components of en_core_web_sm that find sentence boundaries. The parser finds the
+    same boundaries as the full pipeline, the tagger, lemmatizer and ner don't change them.
+    """
+    if senter:
+        segmenter = en_core_web_sm.load(
+            exclude=[
+                "tok2vec",
+                "tagger",
+                "parser",
+                "attribute_ruler",
+                "lemmatizer",
+                "ner",
+            ]
+        )
+        segmenter.enable_pipe("senter")
+        return segmenter
+    return en_core_web_sm.load(
+        exclude=["tagger", "attribute_ruler", "lemmatizer", "ner"]
+    )
+
+
+def get_transform_workers():
+    return state["transform_workers"]
+
+
+def set_transform_workers(workers: int):
+    state["transform_workers"] = max(1, workers)
+
+
+def load_transform_workers():
+    workers = environ.get(TRANSFORM_WORKERS_ENV)
+    if workers:
+        set_transform_workers(int(workers))
+
+
 def set_embeddings(embeddings):
     state["embeddings"] = embeddings
 
@@ -70,3 +128,11 @@ def get_is_client_open():
 
 def get_is_client_open_for_more_than_1_minute():
     return datetime.now().timestamp() - state["last_client_opened_at"] > 60
+
+
+def set_last_search_timestamp():
+    state["last_search_at"] = datetime.now().timestamp()
+
+
+def get_is_search_active(seconds: float = 30):
+    return datetime.now().timestamp() - state["last_search_at"] < seconds
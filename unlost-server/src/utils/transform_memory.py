@@ -1,39 +1,26 @@
-from src.memory import Memory
-from .state import get_nlp
-from .cluster_rectangles import cluster_intersecting_rectangles
-import copy
-
-nlp = get_nlp()
-
-
-def rect_ocr_to_min_max(rect):
-    return [rect[0], 1 - rect[1], rect[0] + rect[2], 1 - rect[1] + rect[3]]
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from src.logger import logger
+from .boxes import ScreenshotBoxes
+from .state import get_segmenter, get_transform_workers
+from .cluster_rectangles import cluster_intersecting_indices
+import math
+import numpy as np
+
+SEGMENT_BATCH_SIZE = 64
+
+
+def rects_ocr_to_min_max(rects: np.ndarray):
+    return np.column_stack(
+        (rects[:, 0], 1 - rects[:, 1], rects[:, 0] + rects[:, 2], 1 - rects[:, 1] + rects[:, 3])
+    )
 
 
 def rect_min_max_to_ocr(rect):
     return [rect[0], 1 - rect[1], rect[2] - rect[0], rect[3] - rect[1]]
 
 
-def get_adjusted_rectangles(rows: list[Memory]):
-    adjusted_rectangles = []
-    adjusted_rectangle_to_result = {}
-    rectangle_to_result = {}
-    adjusted_rectangle_to_rectangle = {}
-    for x in rows:
-        adjusted_rectangle = rect_ocr_to_min_max(x.location)
-        adjusted_rectangles.append(adjusted_rectangle)
-        adjusted_rectangle_to_result[str(adjusted_rectangle)] = x
-        rectangle_to_result[str(x.location)] = x
-        adjusted_rectangle_to_rectangle[str(adjusted_rectangle)] = str(x.location)
-
-    return (
-        adjusted_rectangles,
-        adjusted_rectangle_to_result,
-        rectangle_to_result,
-        adjusted_rectangle_to_rectangle,
-    )
-
-
 def cluster_needs_processing(cluster):
     # if single rectangle, don't process
     if len(cluster) == 1:
@@ -47,121 +34,212 @@ def cluster_needs_processing(cluster):
     return True
 
 
-def transform_memory(memories: list[Memory]) -> list[Memory]:
-    # filter out results that are too high
-    first_memory = Memory.from_memory(memories[0])
-    screenshot_id = first_memory.id.split("#")[0]
-    height = first_memory.screenshot_height
-    valid_memories = [x for x in memories if (1 - x.location[1]) * height > 90]
-
-    (
-        adjusted_rectangles,
-        adjusted_rectangle_to_result,
-        rectangle_to_result,
-        adjusted_rectangle_to_rectangle,
-    ) = get_adjusted_rectangles(valid_memories)
-
-    updated_memories = []
-    clustered = cluster_intersecting_rectangles(adjusted_rectangles, 0.35)
-    sentence_index = 0
-    for cluster in clustered:
-        if not cluster_needs_processing(cluster):
-            for rect in cluster:
-                new_memory = Memory.from_memory(
-                    rectangle_to_result[adjusted_rectangle_to_rectangle[str(rect)]]
-                )
+class ParagraphBlock:
+    sorted_rects: list[list[float]]
+    # text of each rectangle in sorted_rects
+    texts: list[str]
+    original_lengths: list[int]
+    text: str
 
-                new_memory.id = f"{screenshot_id}#{sentence_index}"
-                updated_memories.append(new_memory)
-                sentence_index += 1
+    def __init__(self, sorted_rects, texts, original_lengths, text):
+        self.sorted_rects = sorted_rects
+        self.texts = texts
+        self.original_lengths = original_lengths
+        self.text = text
+
+
+class ScreenshotLayout:
+    boxes: ScreenshotBoxes
+    # (box indices, block) in cluster order, block is None for clusters kept as they are
+    clusters: list[tuple[list[int], ParagraphBlock | None]]
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+        self.clusters = []
+
+
+def layout_memory(boxes: ScreenshotBoxes) -> ScreenshotLayout:
+    # filter out results that are too high
+    height = boxes.screenshot_height
+    locations = np.array(boxes.locations, dtype=np.float64).reshape(-1, 4)
+    valid = (1 - locations[:, 1]) * height > 90
+    valid_indices = np.flatnonzero(valid).tolist()
+    adjusted_rectangles = rects_ocr_to_min_max(locations[valid]).tolist()
+
+    layout = ScreenshotLayout(boxes)
+    for cluster in cluster_intersecting_indices(adjusted_rectangles, 0.35):
+        indices = [valid_indices[i] for i in cluster]
+        if not cluster_needs_processing([adjusted_rectangles[i] for i in cluster]):
+            layout.clusters.append((indices, None))
             continue
 
         original_lengths = []
-        block = []
+        texts = []
 
-        sorted_rects = sorted(cluster, key=lambda x: (x[1], x[0]))
-        for i, rect in enumerate(sorted_rects):
-            item = adjusted_rectangle_to_result[str(rect)]
-            text = item.text
+        order = sorted(
+            cluster, key=lambda i: (adjusted_rectangles[i][1], adjusted_rectangles[i][0])
+        )
+        for i, rect_index in enumerate(order):
+            text = boxes.texts[valid_indices[rect_index]]
             next_length = (
                 original_lengths[-1] + len(text) if len(original_lengths) else len(text)
             )
-            if i < len(sorted_rects) - 1:
+            if i < len(order) - 1:
                 next_length += 1
 
             original_lengths.append(next_length)
-            block.append(text)
-        block = " ".join(block)
+            texts.append(text)
+
+        sorted_rects = [adjusted_rectangles[i] for i in order]
+        layout.clusters.append(
+            (
+                indices,
+                ParagraphBlock(sorted_rects, texts, original_lengths, " ".join(texts)),
+            )
+        )
+
+    return layout
+
+
+def segment_blocks(blocks: list[str]) -> list[list[str]]:
+    # one pipe call over every block in the batch, the segmenter only finds sentence boundaries
+    return [
+        [str(sentence) for sentence in doc.sents]
+        for doc in get_segmenter().pipe(blocks, batch_size=SEGMENT_BATCH_SIZE)
+    ]
+
+
+def align_memory(layout: ScreenshotLayout, sentences) -> ScreenshotBoxes:
+    """
+    Maps segmented sentences back onto the rectangles of their cluster. sentences is an iterator
+    yielding the sentence list of each paragraph block, in the order the blocks were laid out.
+    """
+    boxes = layout.boxes
+    screenshot_id = boxes.screenshot_id
+
+    updated_boxes = boxes.empty()
+    sentence_index = 0
+    for indices, paragraph in layout.clusters:
+        if paragraph is None:
+            for i in indices:
+                updated_boxes.append(
+                    f"{screenshot_id}#{sentence_index}",
+                    boxes.texts[i],
+                    boxes.locations[i],
+                )
+                sentence_index += 1
+            continue
+
+        sorted_rects = paragraph.sorted_rects
+        texts = paragraph.texts
+        # a sentence can't start or end past the last rectangle
+        boundaries = paragraph.original_lengths[:-1]
 
-        doc = nlp(block)
         current = 0
         prev = 0
-        for sentence in doc.sents:
+        for sentence in next(sentences):
             # nlp strips whitespace when splitting sentences, so we need to add it back
-            current += len(str(sentence)) + 1
-
-            start_sub_block = None
-            start_sub_block_offset = 0
-            end_sub_block = None
-            end_sub_block_offset = 0
-            for index, l in enumerate(original_lengths):
-                if index + 1 <= len(original_lengths) - 1:
-                    # print(prev, current, l, prev != 0 and prev > l, current > l, adjusted_rectangle_to_result[str(sorted_rects[index])][0])
-                    if prev >= l:
-                        start_sub_block = index + 1
-                        start_sub_block_offset = prev - l
-                    if current > l:
-                        end_sub_block = index + 1
-                        end_sub_block_offset = current - l
-
-            if start_sub_block is None:
-                start_sub_block = 0
-                start_sub_block_offset = 0
-            if end_sub_block is None:
-                end_sub_block = 0
-                end_sub_block_offset = len(str(sentence)) + 1
-
-            # print(start_sub_block, end_sub_block)
-            if start_sub_block is not None and end_sub_block is not None:
-                original_sub_blocks = copy.deepcopy(
-                    sorted_rects[start_sub_block : end_sub_block + 1]
-                )
-                sub_blocks = copy.deepcopy(original_sub_blocks)
-                # print([adjusted_rectangle_to_result[str(x)][0] for x in sub_blocks])
-                x = sub_blocks[0]
-                text = adjusted_rectangle_to_result[str(x)].text
-                offset_by = start_sub_block_offset / len(text)
+            current += len(sentence) + 1
 
+            # the sentence starts in the rectangle after the last boundary at or before prev,
+            # and ends in the rectangle after the last boundary before current
+            start_sub_block = bisect_right(boundaries, prev)
+            start_sub_block_offset = (
+                prev - boundaries[start_sub_block - 1] if start_sub_block > 0 else 0
+            )
+            end_sub_block = bisect_left(boundaries, current)
+            end_sub_block_offset = (
+                current - boundaries[end_sub_block - 1]
+                if end_sub_block > 0
+                else len(sentence) + 1
+            )
+
+            location = []
+            for index in range(start_sub_block, end_sub_block + 1):
+                x = sorted_rects[index]
                 original_width = x[2] - x[0]
-                sub_blocks[0] = [x[0] + original_width * offset_by, x[1], x[2], x[3]]
-
-                if len(sub_blocks) > 1:
-                    x = sub_blocks[-1]
-                    next_block_index = sorted_rects.index(x)
-                    if next_block_index < len(sorted_rects):
-                        next_text = adjusted_rectangle_to_result[
-                            str(sorted_rects[next_block_index])
-                        ].text
-                        offset_by = end_sub_block_offset / len(next_text)
-
-                        original_width = x[2] - x[0]
-                        sub_blocks[-1] = [
-                            x[0],
-                            x[1],
-                            x[0] + original_width * offset_by,
-                            x[3],
-                        ]
-
-                new_memory = Memory.from_memory(first_memory)
-                new_memory.id = f"{screenshot_id}#{sentence_index}"
-                new_memory.text = str(sentence)
-                new_memory.location = [
-                    item
-                    for sublist in sub_blocks
-                    for item in rect_min_max_to_ocr(sublist)
-                ]
-                updated_memories.append(new_memory)
-                sentence_index += 1
+                minX, maxX = x[0], x[2]
+                if index == start_sub_block:
+                    offset_by = start_sub_block_offset / len(texts[index])
+                    minX = x[0] + original_width * offset_by
+                if index == end_sub_block and index > start_sub_block:
+                    offset_by = end_sub_block_offset / len(texts[index])
+                    maxX = x[0] + original_width * offset_by
+                location += rect_min_max_to_ocr([minX, x[1], maxX, x[3]])
+
+            updated_boxes.append(
+                f"{screenshot_id}#{sentence_index}", sentence, location
+            )
+            sentence_index += 1
 
             prev = current
-    return updated_memories
+    return updated_boxes
+
+
+def transform_screenshots(
+    screenshots: list[ScreenshotBoxes],
+) -> list[ScreenshotBoxes]:
+    layouts = [layout_memory(x) if len(x) > 0 else None for x in screenshots]
+    blocks = [
+        paragraph.text
+        for layout in layouts
+        if layout is not None
+        for _, paragraph in layout.clusters
+        if paragraph is not None
+    ]
+    sentences = iter(segment_blocks(blocks))
+    return [
+        align_memory(layout, sentences) if layout is not None else boxes
+        for boxes, layout in zip(screenshots, layouts)
+    ]
+
+
+def transform_memory(boxes: ScreenshotBoxes) -> ScreenshotBoxes:
+    return transform_screenshots([boxes])[0]
+
+
+# batches smaller than this are transformed in-process, a pool round trip isn't worth it
+POOL_MIN_SCREENSHOTS = 8
+
+executor: ProcessPoolExecutor | None = None
+executor_workers = 0
+
+
+def get_executor(workers: int):
+    global executor, executor_workers
+    if executor is None or executor_workers != workers:
+        shutdown_executor()
+        executor = ProcessPoolExecutor(max_workers=workers)
+        executor_workers = workers
+    return executor
+
+
+def shutdown_executor():
+    global executor, executor_workers
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+    executor = None
+    executor_workers = 0
+
+
+def transform_memories(
+    screenshots: list[ScreenshotBoxes], workers: int | None = None
+) -> list[ScreenshotBoxes]:
+    """
+    Transforms the boxes of every screenshot in a batch, sharding screenshots across a process pool
+    when the batch is large enough. Results are returned in the same order as screenshots.
+    """
+    workers = workers if workers is not None else get_transform_workers()
+    if workers <= 1 or len(screenshots) < POOL_MIN_SCREENSHOTS:
+        return transform_screenshots(screenshots)
+
+    size = math.ceil(len(screenshots) / workers)
+    shards = [screenshots[i : i + size] for i in range(0, len(screenshots), size)]
+    try:
+        results = list(get_executor(workers).map(transform_screenshots, shards))
+    except BrokenProcessPool:
+        logger.error("transform pool is broken, falling back to serial transform")
+        shutdown_executor()
+        return transform_screenshots(screenshots)
+
+    return [boxes for shard in results for boxes in shard]
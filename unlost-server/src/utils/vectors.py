@@ -0,0 +1,87 @@
+import os
+
+import numpy as np
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# the quantizer is trained on at most this many rows, rows are added this many at a time
+TRAIN_SAMPLE = 100_000
+ADD_BATCH = 50_000
+
+
+class VectorStore:
+    """
+    Full precision copy of the vectors of a quantized index, one float32 row per indexid in a
+    flat file. Only the rows of search candidates are read back, through a memory map.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, offset: int, vectors: np.ndarray, reset=False):
+        """
+        Writes the vectors of indexids offset, offset + 1, ... A reset drops every row first,
+        for indexes rebuilt from scratch.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        # a new shard's directory is only created by its first save
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        mode = "wb" if reset or not os.path.exists(self.path) else "r+b"
+        with open(self.path, mode) as handle:
+            # seeking past the end pads the rows in between with zeros
+            handle.seek(offset * vectors.shape[1] * vectors.itemsize)
+            handle.write(vectors.tobytes())
+
+    def read(self, indexids: list[int], dimensions: int) -> np.ndarray:
+        """
+        Returns the rows of indexids, rows that were never written are all zeros.
+        """
+        rows = np.zeros((len(indexids), dimensions), dtype=np.float32)
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        count = size // (dimensions * rows.itemsize)
+        if count == 0:
+            return rows
+
+        stored = np.memmap(self.path, dtype=np.float32, mode="r", shape=(count, dimensions))
+        indexids = np.asarray(indexids, dtype=np.int64)
+        found = indexids < count
+        rows[found] = stored[indexids[found]]
+        del stored
+        return rows
+
+
+def train_index(
+    ann, store: VectorStore, indexids: np.ndarray, dimensions: int
+) -> str | None:
+    """
+    Replaces the faiss index of a txtai ann with one trained on the stored vectors of indexids,
+    configured from the ann's settings for their count. Rows keep their indexids. Returns the
+    index components, or None if the vectors of some rows were never stored.
+    """
+    sample = indexids
+    if len(indexids) > TRAIN_SAMPLE:
+        sample = np.sort(
+            np.random.default_rng(0).choice(indexids, TRAIN_SAMPLE, replace=False)
+        )
+    train = store.read(sample, dimensions)
+    if not train.any(axis=1).all():
+        return None
+
+    params = ann.configure(len(indexids), len(sample))
+    backend = faiss.index_factory(dimensions, params, faiss.METRIC_INNER_PRODUCT)
+    backend.train(train)
+    del train
+
+    for i in range(0, len(indexids), ADD_BATCH):
+        batch = np.ascontiguousarray(indexids[i : i + ADD_BATCH], dtype=np.int64)
+        vectors = store.read(batch, dimensions)
+        if not vectors.any(axis=1).all():
+            return None
+        backend.add_with_ids(vectors, batch)
+
+    ann.backend = backend
+    ann.metadata({"components": params})
+    return params
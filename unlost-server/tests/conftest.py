@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the server runs from its own directory, models such as query_classifier.pickle are loaded from it
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
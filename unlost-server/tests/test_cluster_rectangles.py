@@ -0,0 +1,23 @@
+import random
+
+from benchmarks.layouts import pairwise_cluster_rectangles, screen_layout
+from src.utils.cluster_rectangles import cluster_intersecting_rectangles
+
+
+def test_matches_pairwise_clustering():
+    rng = random.Random(1)
+    for k in range(600):
+        rects = screen_layout(rng, rng.choice([0, 1, 2, 5, 50, 200, 400]), k % 2 == 0)
+        if k % 7 == 0:
+            # identical boxes, e.g. the same label repeated
+            rects += [list(x) for x in rects[:3]]
+        assert cluster_intersecting_rectangles(
+            rects, 0.35
+        ) == pairwise_cluster_rectangles(rects, 0.35)
+
+
+def test_zero_height_boxes_stay_alone():
+    rects = [[0.1, 0.1, 0.2, 0.1], [0.1, 0.1, 0.2, 0.1], [0.1, 0.1, 0.2, 0.12]]
+    assert cluster_intersecting_rectangles(
+        rects, 0.35
+    ) == pairwise_cluster_rectangles(rects, 0.35)
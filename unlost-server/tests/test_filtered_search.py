@@ -0,0 +1,35 @@
+from collections import Counter
+import random
+
+import pytest
+
+pytest.importorskip("txtai")
+pytest.importorskip("faiss")
+
+from benchmarks.keywords import keyword_database, keyword_scoring, screen_texts, vocabulary
+from src.utils.filtered_search import normalize_keyword
+
+
+def test_keyword_scores_match_txtai_scoring():
+    rng = random.Random(0)
+    words = vocabulary(rng, 400)
+    texts = screen_texts(rng, words, 2000)
+    scoring = keyword_scoring(texts)
+    database = keyword_database(texts)
+
+    rows = Counter(x for text in texts for x in set(text.split()))
+    # fts5 floors the idf of terms in more than half the rows, txtai doesn't
+    terms = [x for x in words if 0 < rows[x] < len(texts) / 4]
+    assert database.keywordaverage() == pytest.approx(scoring.avgscore, rel=0.05)
+
+    for _ in range(200):
+        query = " ".join(rng.sample(terms, rng.randint(1, 3)))
+        expected = dict(scoring.search(query, 20))
+        actual = normalize_keyword(
+            database.keyword(query, 20), database.keywordaverage()
+        )
+        assert len(actual) > 0
+        assert actual[0][1] == pytest.approx(max(expected.values()), abs=0.03)
+        for uid, score in actual:
+            if uid in expected:
+                assert score == pytest.approx(expected[uid], abs=0.03)
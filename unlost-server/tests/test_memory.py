@@ -0,0 +1,220 @@
+from hashlib import sha1
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip("txtai")
+faiss = pytest.importorskip("faiss")
+pytest.importorskip("en_core_web_sm")
+
+from txtai.vectors.transformers import TransformersVectors
+
+from src import memory
+from src.memory import Memory, StoreMemory, split_repeats
+from src.utils.query import ParsedQuery
+from src.utils.state import set_document_path, set_embeddings
+
+DIMENSIONS = 16
+
+
+class HashEncoder:
+    # deterministic vectors, a text always encodes the same way
+    def encode(self, texts, batch_size=32, **kwargs):
+        return np.array(
+            [
+                np.random.default_rng(
+                    int(sha1(text.encode("utf-8")).hexdigest()[:8], 16)
+                ).standard_normal(DIMENSIONS)
+                for text in texts
+            ],
+            dtype=np.float32,
+        )
+
+
+class HashVectors(TransformersVectors):
+    def load(self, path):
+        return HashEncoder()
+
+
+def create_memory(i: int):
+    return Memory(
+        id=f"memory-{i}",
+        text=f"memory text number {i}",
+        app_name="app",
+        window_name="window",
+        captured_at=f"2024-01-01T10:00:{i:02d}.000",
+        location=[0.1, 0.1, 0.2, 0.2],
+        screenshot_path="screenshot.png",
+        screenshot_time=float(i),
+        screenshot_time_to=None,
+        screenshot_minX=0,
+        screenshot_minY=0,
+        screenshot_width=100,
+        screenshot_height=100,
+        url=None,
+    )
+
+
+def store(memories: list[Memory]):
+    store_memory = StoreMemory()
+    store_memory.add_memories(memories)
+    store_memory.persist()
+
+
+@pytest.fixture
+def embedding(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        memory, "load_vectors", lambda: HashVectors(dict(memory.EMBEDDING_CONFIG), None)
+    )
+    set_document_path(str(tmp_path))
+    set_embeddings(None)
+    yield memory.get_embedding()
+    set_embeddings(None)
+
+
+def row_counts(shard):
+    # vectors and rows of the writer and of the published snapshot. Counting similar() hits
+    # would miss the random vectors that score below 0 against the query.
+    with shard.reading() as instance:
+        published = instance
+    return [
+        (x.ann.count(), x.database.count()) for x in (shard.instance, published)
+    ]
+
+
+def test_retried_upsert_leaves_no_ghost_rows(embedding):
+    memories = [create_memory(i) for i in range(10)]
+    store(memories)
+    # a batch retried after a failure upserts the same ids again
+    store(memories)
+    shard = embedding.shards["2024-01"]
+    assert row_counts(shard) == [(10, 10), (10, 10)]
+
+    # the next swap catches the previous snapshot up with the writes it missed
+    store([create_memory(i) for i in range(10, 15)])
+    assert row_counts(shard) == [(15, 15), (15, 15)]
+
+    # the saved index and its segments load the same rows
+    set_embeddings(None)
+    assert row_counts(memory.get_embedding().shard("2024-01")) == [(15, 15), (15, 15)]
+
+
+def scalar_quantizer(instance):
+    index = faiss.downcast_index(instance.ann.backend)
+    return faiss.downcast_index(index.index) if hasattr(index, "id_map") else index
+
+
+def test_quantizer_is_trained_at_compaction(embedding, monkeypatch):
+    monkeypatch.setattr(memory, "QUANTIZE_MIN_ROWS", 20)
+    store([create_memory(i) for i in range(10)])
+    shard = embedding.shards["2024-01"]
+    shard.compact()
+    # too few rows to train on, the index stays float32
+    assert isinstance(scalar_quantizer(shard.instance), faiss.IndexFlat)
+
+    store([create_memory(i) for i in range(10, 25)])
+    shard.compact()
+    vectors = shard.vectors.read(list(range(25)), DIMENSIONS)
+    for instance in (shard.instance, shard.published.instance):
+        index = scalar_quantizer(instance)
+        assert isinstance(index, faiss.IndexScalarQuantizer)
+        assert index.sq.qtype == faiss.ScalarQuantizer.QT_8bit
+        assert instance.ann.count() == 25
+        # the ranges of every dimension are those of all 25 rows
+        trained = faiss.vector_to_array(index.sq.trained)
+        np.testing.assert_allclose(trained[:DIMENSIONS], vectors.min(axis=0), atol=1e-6)
+        np.testing.assert_allclose(
+            trained[DIMENSIONS:], vectors.max(axis=0) - vectors.min(axis=0), atol=1e-6
+        )
+
+    # rows appended after training are indexed by the trained quantizer
+    store([create_memory(i) for i in range(25, 30)])
+    assert row_counts(shard) == [(30, 30), (30, 30)]
+    assert isinstance(scalar_quantizer(shard.published.instance), faiss.IndexScalarQuantizer)
+
+
+class StoredDatabase:
+    def __init__(self, stored: dict):
+        self.stored = stored
+
+    def sectionids(self, keys):
+        return {key: self.stored[key] for key in keys if key in self.stored}
+
+
+def test_split_repeats_upserts_own_rows_again():
+    docs = [
+        (
+            x.id,
+            {
+                "text": x.text,
+                "meta": json.dumps(
+                    {
+                        "captured_at": x.captured_at,
+                        "location": x.location,
+                        "path": x.screenshot_path,
+                        "time": x.screenshot_time,
+                        "app_name": x.app_name,
+                        "window_name": x.window_name,
+                        "is_transcription": False,
+                    }
+                ),
+            },
+            None,
+        )
+        for x in [create_memory(0), create_memory(1)]
+    ]
+    keys = [
+        memory.FileDB.sectionkey(
+            x[1]["text"], "app", "window", json.loads(x[1]["meta"])["captured_at"]
+        )
+        for x in docs
+    ]
+    # memory-0 is stored from a failed attempt of this batch, memory-1 repeats another memory
+    database = StoredDatabase({keys[0]: "memory-0", keys[1]: "memory-9"})
+
+    new_docs, repeats = split_repeats(database, docs)
+    assert [x[0] for x in new_docs] == ["memory-0"]
+    assert [(id, occurrence[0]) for id, occurrence in repeats] == [
+        ("memory-1", "memory-9")
+    ]
+
+
+def test_search_pages_fetch_lazily_and_cursors_stay_with_their_search(monkeypatch):
+    limits = []
+
+    def memory_search(parsed_query, tags=None, limit=memory.SEARCH_LIMIT):
+        limits.append(limit)
+        rows = 1000 if parsed_query.text == "many" else 100
+        return [{"text": f"{parsed_query.text} {i}"} for i in range(min(rows, limit))]
+
+    monkeypatch.setattr(memory, "memory_search", memory_search)
+    many = ParsedQuery(None, "many", False)
+    page, cursor = memory.memory_search_page(many, "[]")
+    assert len(page) == memory.PAGE_SIZE and limits == [memory.FIRST_SEARCH_LIMIT]
+
+    # pages inside the first fetch are read from the cursor, the next one fetches again
+    memory.memory_search_page(many, "[]", memory.PAGE_SIZE, cursor)
+    assert limits == [memory.FIRST_SEARCH_LIMIT]
+    offset = memory.FIRST_SEARCH_LIMIT
+    page, next_cursor = memory.memory_search_page(many, "[]", offset, cursor)
+    assert next_cursor == cursor and page[0]["text"] == f"many {offset}"
+    assert limits == [memory.FIRST_SEARCH_LIMIT, memory.FIRST_SEARCH_LIMIT * 2]
+
+    # the last page reaches SEARCH_LIMIT and nothing is fetched past it
+    offset = memory.SEARCH_LIMIT - memory.PAGE_SIZE
+    assert len(memory.memory_search_page(many, "[]", offset, cursor)[0]) > 0
+    assert memory.memory_search_page(many, "[]", memory.SEARCH_LIMIT, cursor)[0] == []
+    assert limits[-1] == memory.SEARCH_LIMIT and len(limits) == 3
+
+    # a search that ran out before its limit is never fetched again
+    few = ParsedQuery(None, "few", False)
+    _, few_cursor = memory.memory_search_page(few, "[]")
+    assert memory.memory_search_page(few, "[]", memory.PAGE_SIZE, few_cursor)[0] == []
+    assert len(limits) == 4
+
+    # the cursor of another query or other tags isn't read, the search runs again
+    for query, tags in ((few, "[]"), (many, '[{"type": "app_name", "value": "app"}]')):
+        page, other = memory.memory_search_page(query, tags, 0, cursor)
+        assert other != cursor and page[0]["text"].startswith(query.text)
+    assert len(limits) == 6
@@ -0,0 +1,112 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("txtai")
+pytest.importorskip("onnxruntime")
+pytest.importorskip("en_core_web_sm")
+
+from src.memory import EMBEDDING_MODEL, ONNX_MODEL_PATH
+from src.utils.onnx_encoder import OnnxEncoder, load_onnx_vectors, pooling_mode
+
+TEXTS = [
+    "Pull request #42: fix race condition in file watcher",
+    "Inbox (3) - Quarterly planning meeting moved to Thursday 3pm",
+    "def cluster_intersecting_rectangles(rects, threshold):",
+    "Slack | #general | Alice: the deploy is green, shipping after lunch",
+    "Invoice total $1,284.50 due 2023-11-30",
+    "a",
+    " ".join(["screen text that runs past the token limit"] * 200),
+]
+
+
+def write_pooling(path, config):
+    os.makedirs(f"{path}/1_Pooling")
+    with open(f"{path}/1_Pooling/config.json", "w") as f:
+        json.dump(config, f)
+
+
+def test_pooling_mode(tmp_path):
+    assert pooling_mode(str(tmp_path), "BAAI/bge-small-en") == "cls"
+    with pytest.raises(ValueError):
+        pooling_mode(str(tmp_path), "sentence-transformers/all-MiniLM-L6-v2")
+
+    write_pooling(
+        tmp_path,
+        {"pooling_mode_cls_token": False, "pooling_mode_mean_tokens": True},
+    )
+    assert pooling_mode(str(tmp_path), "BAAI/bge-small-en") == "mean"
+
+
+def test_unsupported_pooling(tmp_path):
+    write_pooling(tmp_path, {"pooling_mode_max_tokens": True})
+    with pytest.raises(ValueError):
+        pooling_mode(str(tmp_path), "BAAI/bge-small-en")
+
+
+def test_corrupt_export_isnt_loaded(tmp_path):
+    (tmp_path / "model.onnx").write_bytes(b"not an onnx model")
+    (tmp_path / "tokenizer.json").write_text("{}")
+    assert load_onnx_vectors({"path": "BAAI/bge-small-en"}, str(tmp_path)) is None
+
+
+# sections to search and queries for the retrieval check
+CORPUS = [
+    "Quarterly planning: roadmap review, hiring plan and budget for Q3",
+    "git rebase -i HEAD~3 squash the fixup commits before pushing",
+    "Flight BA 117 London Heathrow to New York JFK departs 08:25 gate B32",
+    "Recipe: slow cooked beef ragu with pappardelle, serves four",
+    "Error: connection refused while connecting to postgres on port 5432",
+    "Your Amazon order of noise cancelling headphones has shipped",
+    "Standup notes: blocked on the design review for the onboarding flow",
+    "Spotify - Discover Weekly - 30 songs, 1 hr 52 min",
+    "pytest tests/test_memory.py -q 3 passed in 6.79s",
+    "Figma - Mobile checkout redesign - frame 12 of 40",
+    "Invoice #2031 from Acme Hosting, amount due $49.00",
+    "Weather: light rain in Seattle, high of 12 degrees",
+    "Calendar: dentist appointment Thursday at 4:30 pm",
+    "Kubernetes pod crashloopbackoff in namespace payments",
+    "Reading list: Designing Data-Intensive Applications chapter 5 replication",
+    "Slack huddle with the data team about the churn dashboard",
+]
+QUERIES = [
+    "database connection error",
+    "travel booking to new york",
+    "music playlist",
+    "meeting about product plans",
+    "bill to pay for servers",
+    "unit test results",
+]
+TOP_K = 3
+# int8 weights drift from the torch model, fp32 only differs by float error
+EXPORTS = [("model.onnx", 0.999, 1.0), ("model_quantized.onnx", 0.98, 0.8)]
+
+
+@pytest.mark.parametrize("model_file,min_cosine,min_agreement", EXPORTS)
+def test_matches_sentence_transformers(model_file, min_cosine, min_agreement):
+    sentence_transformers = pytest.importorskip("sentence_transformers")
+    if not os.path.exists(f"{ONNX_MODEL_PATH}/{model_file}"):
+        pytest.skip(f"no {model_file} in {ONNX_MODEL_PATH}")
+
+    model = sentence_transformers.SentenceTransformer(EMBEDDING_MODEL)
+    encoder = OnnxEncoder(
+        ONNX_MODEL_PATH, pooling_mode(ONNX_MODEL_PATH, EMBEDDING_MODEL), model_file
+    )
+    texts = TEXTS + CORPUS + QUERIES
+    expected = model.encode(texts, normalize_embeddings=True)
+    actual = encoder.encode(texts, batch_size=4)
+    cosine = (actual * expected).sum(axis=1)
+    assert np.all(cosine >= min_cosine), cosine
+
+    # the sections each query finds first
+    corpus, queries = slice(len(TEXTS), -len(QUERIES)), slice(-len(QUERIES), None)
+    agreement = []
+    for vectors in (expected, actual):
+        scores = vectors[queries] @ vectors[corpus].T
+        agreement.append(np.argsort(-scores, axis=1)[:, :TOP_K])
+    overlap = [
+        len(set(a) & set(b)) / TOP_K for a, b in zip(agreement[0].tolist(), agreement[1].tolist())
+    ]
+    assert np.mean(overlap) >= min_agreement, overlap
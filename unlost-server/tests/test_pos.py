@@ -0,0 +1,93 @@
+from datetime import timedelta
+
+import pytest
+
+pytest.importorskip("dateparser")
+pytest.importorskip("en_core_web_sm")
+
+from src.utils.pos import entity_date_text, nlp, parse_date_condition, rule_date_text
+
+# queries the rules answer without spacy, each must give the condition spacy's entity gives
+RULE_QUERIES = [
+    "slack messages today",
+    "what did i read yesterday",
+    "emails from yesterday",
+    "pull requests since yesterday",
+    "notes before today",
+    "meeting notes on monday",
+    "standup on friday",
+    "design review from tuesday",
+    "docs from last week",
+    "invoices in last month",
+    "photos from last year",
+    "commits in past week",
+    "tickets from past 3 days",
+    "articles from last 2 weeks",
+    "errors in previous hour",
+    "budget spreadsheet from previous month",
+    "calls from last monday",
+    "recipes from last sunday",
+    "videos from 3 days ago",
+    "slides since 2 weeks ago",
+    "tweets from 2 hours ago",
+    "receipt 2023-05-01",
+    "logs after 2023-11-20",
+    "contract before 2023-01-15",
+]
+
+# queries the rules leave to spacy: more than one date word, so only spacy decides which one is
+# the date, an article spacy makes part of the entity, or expressions the rules don't know
+ENTITY_QUERIES = [
+    "meeting on monday about friday's release",
+    "notes from yesterday morning",
+    "last week's plan for today",
+    "emails from last week this year",
+    "report from 2 days ago at noon",
+    "deploy on friday afternoon",
+    "invoices in the last month",
+    "commits in the past week",
+    "tickets from the past 3 days",
+    "articles from the last 2 weeks",
+    "errors in the previous hour",
+    "screenshots from march",
+    "notes from 12 march 2023",
+    "emails since 03/14/2023",
+    "slides from this week",
+    "photos from christmas",
+    "standup notes tomorrow",
+    "docs from earlier today",
+    "chat from the weekend",
+]
+
+requires_ner = pytest.mark.skipif(
+    "ner" not in nlp.pipe_names, reason="needs the entity recognizer of en_core_web_sm"
+)
+
+
+@requires_ner
+@pytest.mark.parametrize("sentence", RULE_QUERIES)
+def test_rules_match_spacy(sentence):
+    rule_text = rule_date_text(sentence)
+    assert rule_text is not None
+
+    expected = parse_date_condition(sentence, entity_date_text(sentence))
+    actual = parse_date_condition(sentence, rule_text)
+    assert expected is not None and actual is not None
+    assert actual.range_type == expected.range_type
+    assert actual.clean_text == expected.clean_text
+    # both parse relative to now, a moment apart
+    for a, b in [
+        (actual.parsed_date, expected.parsed_date),
+        (actual.from_date, expected.from_date),
+        (actual.to_date, expected.to_date),
+    ]:
+        assert abs(a - b) < timedelta(minutes=1) or a == b
+
+
+@pytest.mark.parametrize("sentence", ENTITY_QUERIES)
+def test_rules_leave_ambiguous_queries_to_spacy(sentence):
+    assert rule_date_text(sentence) is None
+
+
+def test_rules_cover_rule_queries():
+    assert [x for x in RULE_QUERIES if rule_date_text(x) is None] == []
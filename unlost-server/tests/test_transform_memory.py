@@ -0,0 +1,58 @@
+import subprocess
+import sys
+
+import pytest
+
+en_core_web_sm = pytest.importorskip("en_core_web_sm")
+
+from tests.conftest import ROOT
+
+# what a spawned pool worker imports to unpickle transform_screenshots, torch is left out of the
+# check since thinc imports it for spacy whenever it is installed
+WORKER_IMPORTS = """
+import sys
+import src.utils.transform_memory
+print(",".join(x for x in ["src.memory", "txtai", "sentence_transformers"] if x in sys.modules))
+"""
+
+
+def test_pool_workers_skip_the_memory_imports():
+    result = subprocess.run(
+        [sys.executable, "-c", WORKER_IMPORTS],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == ""
+
+
+def test_transform_workers_from_environment(monkeypatch):
+    from src.utils import state
+
+    monkeypatch.setitem(state.state, "transform_workers", 4)
+    monkeypatch.setenv(state.TRANSFORM_WORKERS_ENV, "1")
+    state.load_transform_workers()
+    assert state.get_transform_workers() == 1
+
+    monkeypatch.delenv(state.TRANSFORM_WORKERS_ENV)
+    state.set_transform_workers(3)
+    state.load_transform_workers()
+    assert state.get_transform_workers() == 3
+
+
+@pytest.mark.skipif(
+    "parser" not in en_core_web_sm.load().pipe_names,
+    reason="needs the parser of en_core_web_sm",
+)
+def test_segmenter_keeps_the_parser_unless_senter_is_enabled(monkeypatch):
+    from src.utils import state
+
+    monkeypatch.setitem(state.state, "segmenter", None)
+    monkeypatch.delenv(state.SENTER_SEGMENTATION_ENV, raising=False)
+    assert "parser" in state.get_segmenter().pipe_names
+
+    monkeypatch.setitem(state.state, "segmenter", None)
+    monkeypatch.setenv(state.SENTER_SEGMENTATION_ENV, "1")
+    segmenter = state.get_segmenter()
+    assert "parser" not in segmenter.pipe_names and "senter" in segmenter.pipe_names
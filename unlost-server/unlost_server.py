@@ -1,22 +1,40 @@
 from multiprocessing import freeze_support
+
+if __name__ == "__main__":
+    # a frozen transform pool worker starts from this script too, hand it to multiprocessing
+    # before the server imports below load txtai and torch into every worker
+    freeze_support()
+
 from os import getpid
 from sys import argv
 
 from uvicorn import run
 from fastapi import FastAPI
 from psutil import Process
-from fastapi_utils.tasks import repeat_every
 
-from src.process_screenshots import process_screenshots
-from src.memory import get_tags, get_transcription, memory_search, remove_memory
+from src.pipeline import (
+    get_pipeline_stats,
+    start_pipeline,
+    stop_pipeline,
+    wake_pipeline,
+)
+from src.memory import (
+    get_stats,
+    get_tags,
+    get_transcription,
+    memory_search_page,
+    remove_memory,
+)
 from src.logger import catch_exceptions_middleware, set_logger_path
 from src.utils.state import (
     get_is_deleting,
     get_migration_state,
+    load_transform_workers,
     set_document_path,
     set_last_client_timestamp,
 )
 from src.utils.pos import get_date_condition
+from src.utils.query import parse_query, parsed_queries
 
 app = FastAPI()
 
@@ -50,23 +68,37 @@ def get_transcription_api(path: str):
 
 
 @app.get("/memory")
-def get_memory_api(query: str, tags: str | None = None, offset: int = 0):
+def get_memory_api(
+    query: str, tags: str | None = None, offset: int = 0, cursor: str | None = None
+):
     if get_migration_state() is not None:
-        return {"memories": [], "scanned_count": 0, "date_condition": None}
+        return {
+            "memories": [],
+            "scanned_count": 0,
+            "date_condition": None,
+            "cursor": None,
+        }
 
     clean_query = query.replace("'", "").replace(";", "")
-    date_condition = None
-    if "date_between" not in tags:
-        date_condition = get_date_condition(clean_query)
+    parsed_query = parse_query(clean_query, "date_between" not in tags)
 
-    memories = memory_search(clean_query, tags, date_condition)
+    memories, cursor = memory_search_page(parsed_query, tags, offset, cursor)
 
+    # the parsed query is cached, format a copy of its date condition
+    date_condition = parsed_query.date_condition
     if date_condition:
+        date_condition = date_condition.copy()
         date_condition.from_date = date_condition.from_date.strftime(
             "%Y-%m-%dT%H:%M:%S"
         )
         date_condition.to_date = date_condition.to_date.strftime("%Y-%m-%dT%H:%M:%S")
-    return {"memories": memories, "scanned_count": 0, "date_condition": date_condition}
+    # scanned_count is the offset of the next page relative to this one
+    return {
+        "memories": memories,
+        "scanned_count": len(memories),
+        "date_condition": date_condition,
+        "cursor": cursor,
+    }
     # return {"memories": [], "scanned_count": 0, "date_condition": date_condition}
 
 
@@ -82,9 +114,18 @@ def get_tags_api():
     return get_tags()
 
 
+@app.get("/stats")
+def stats_api():
+    return {
+        **get_stats(),
+        "ingestion": get_pipeline_stats(),
+        "parsed_queries": parsed_queries.stats(),
+    }
+
+
 @app.post("/test")
 def test_api():
-    process_screenshots()
+    wake_pipeline()
     return True
 
 
@@ -108,20 +149,25 @@ def state_api():
 
 
 @app.on_event("startup")
-@repeat_every(seconds=60)
-def process_screenshots_cron():
-    process_screenshots()
+def start_ingestion():
+    start_pipeline()
+
+
+@app.on_event("shutdown")
+def stop_ingestion():
+    stop_pipeline()
 
 
 def run_api_server(doc_path=""):
     if doc_path:
         set_document_path(doc_path)
         set_logger_path(doc_path)
+    load_transform_workers()
 
     run(app, host="0.0.0.0", port=58000)
 
 
 if __name__ == "__main__":
-    freeze_support()
-    get_date_condition("test")
+    # warm up dateparser, "test" alone no longer reaches it
+    get_date_condition("test last week")
     run_api_server(doc_path=argv[1])